@@ -1,23 +1,37 @@
 import os
 import re
+import html
+import time
 import asyncio
 import logging
+import functools
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
 from dataclasses import dataclass
-from typing import Optional, List, Dict, Tuple
+from typing import Any, Optional, Union, List, Dict, Tuple, AsyncIterator, Awaitable, Callable
 
-from aiogram import Bot, Dispatcher, Router, F
+from aiogram import BaseMiddleware, Bot, Dispatcher, Router, F
 from aiogram.types import (
-    Message, CallbackQuery,
+    TelegramObject, Message, CallbackQuery,
     InlineKeyboardMarkup, InlineKeyboardButton,
-    InputMediaPhoto, InputMediaVideo
+    InputMedia, InputMediaPhoto, InputMediaVideo
 )
-from aiogram.enums import ParseMode
+from aiogram.enums import ParseMode, ContentType
+from aiogram.exceptions import TelegramBadRequest, TelegramNotFound, TelegramRetryAfter
 from aiogram.client.default import DefaultBotProperties
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware, NextRequestMiddlewareType
+from aiogram.methods import AnswerCallbackQuery, GetUpdates, Response, TelegramMethod
+from aiogram.methods.base import TelegramType
 from aiogram.filters import Command, CommandStart
+from aiogram.filters.callback_data import CallbackData
+from aiogram.dispatcher.flags import get_flag
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
+from aiogram.fsm.storage.memory import MemoryStorage, SimpleEventIsolation
 
 import aiosqlite
+import orjson
 from dotenv import load_dotenv
 
 # -------------------- CONFIG --------------------
@@ -33,22 +47,239 @@ if not BOT_TOKEN:
 logging.basicConfig(level=logging.INFO)
 log = logging.getLogger("shop_bot")
 
+
+# -------------------- TELEGRAM SESSION --------------------
+class RateLimiter:
+    """Token bucket: в среднем не больше rate вызовов в секунду, всплеск до burst."""
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._ts = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._ts) * self.rate)
+                self._ts = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+class FloodControl(BaseRequestMiddleware):
+    """Все исходящие запросы к Bot API — через общий token bucket (~30 msg/s у Telegram).
+
+    Поймали 429 — ставим на паузу на retry_after запросы в тот же чат и повторяем,
+    а не даём каждому обработчику долбить API своими ретраями. Если у метода нет
+    chat_id, пауза общая. getUpdates и answerCallbackQuery в лимит не входят — их не держим.
+    """
+
+    FREE_METHODS = (GetUpdates, AnswerCallbackQuery)
+
+    def __init__(self, limiter: RateLimiter, attempts: int = 3):
+        self.limiter = limiter
+        self.attempts = attempts
+        # chat_id -> когда снова можно слать; None — пауза для всех чатов
+        self._resume_at: Dict[Optional[Union[int, str]], float] = {}
+
+    async def __call__(
+        self,
+        make_request: NextRequestMiddlewareType[TelegramType],
+        bot: Bot,
+        method: TelegramMethod[TelegramType],
+    ) -> Response[TelegramType]:
+        if isinstance(method, self.FREE_METHODS):
+            return await make_request(bot, method)
+        chat_id = getattr(method, "chat_id", None)
+        for attempt in range(self.attempts):
+            resume_at = max(self._resume_at.get(None, 0.0), self._resume_at.get(chat_id, 0.0))
+            pause = resume_at - time.monotonic()
+            if pause > 0:
+                await asyncio.sleep(pause)
+            await self.limiter.acquire()
+            try:
+                return await make_request(bot, method)
+            except TelegramRetryAfter as e:
+                if attempt == self.attempts - 1:
+                    raise
+                self._pause(chat_id, e.retry_after)
+                log.warning("flood control: %s (chat %s), pause %ss", type(method).__name__, chat_id, e.retry_after)
+
+    def _pause(self, chat_id: Optional[Union[int, str]], retry_after: float):
+        now = time.monotonic()
+        # истёкшие паузы выкидываем — иначе словарь рос бы на каждый чат, где ловили 429
+        for key in [k for k, ts in self._resume_at.items() if ts <= now]:
+            del self._resume_at[key]
+        self._resume_at[chat_id] = max(self._resume_at.get(chat_id, 0.0), now + retry_after)
+
+
+class KeepAliveSession(AiohttpSession):
+    """AiohttpSession с настраиваемым keep-alive коннектора.
+
+    У aiohttp он 15 с — между тапами соединение успевало закрыться, и ответ начинался
+    с нового TLS-рукопожатия. Публичного параметра у AiohttpSession нет, поэтому
+    дописываем аргумент коннектора здесь, в одном месте: коннектор из них собирается
+    лениво в create_session(), на первом запросе.
+    """
+
+    def __init__(self, keepalive_timeout: float, **kwargs: Any):
+        super().__init__(**kwargs)
+        self._connector_init["keepalive_timeout"] = keepalive_timeout
+
+
+# Одна aiohttp-сессия на всё время работы: соединения с api.telegram.org переиспользуются.
+# ответы Bot API (getUpdates, editMessageText, ...) разбираем orjson — он заметно быстрее json
+TG_KEEPALIVE = 75.0
+session = KeepAliveSession(
+    keepalive_timeout=TG_KEEPALIVE,
+    limit=100,
+    json_loads=orjson.loads,
+    json_dumps=lambda obj: orjson.dumps(obj).decode(),
+)
+session.middleware(FloodControl(RateLimiter(rate=25, burst=25)))
+
 bot = Bot(
     token=BOT_TOKEN,
+    session=session,
     default=DefaultBotProperties(parse_mode=ParseMode.HTML),
 )
 
-dp = Dispatcher()
+# FSM только в памяти: диалоги админки короткие, после рестарта их можно начать заново.
+# SimpleEventIsolation: апдейты одного пользователя в одном чате идут по очереди — лок берётся
+# ещё до чтения состояния, так что двойной тап «Удалить» или быстрый повторный ввод в FSM
+# не проходят в обработчик дважды; разные пользователи друг друга не ждут.
+dp = Dispatcher(storage=MemoryStorage(), events_isolation=SimpleEventIsolation())
 router = Router()
 dp.include_router(router)
 
 
+# -------------------- SQL --------------------
+# Постоянные тексты запросов: на долгоживущих соединениях SQLite достаёт уже
+# подготовленные statement'ы из своего кэша, а не парсит SQL заново.
+SQL_SET_SETTING = (
+    "INSERT INTO settings(key,value) VALUES(?,?) "
+    "ON CONFLICT(key) DO UPDATE SET value=excluded.value"
+)
+SQL_CATALOG_TREE = (
+    "SELECT c.id AS cat_id, c.name AS cat_name, s.id AS sub_id, s.name AS sub_name, "
+    "p.id AS prod_id, p.name AS prod_name "
+    "FROM categories c "
+    "LEFT JOIN subcategories s ON s.category_id = c.id "
+    "LEFT JOIN products p ON p.subcategory_id = s.id "
+    "ORDER BY c.pos, c.id, s.pos, s.id, p.pos, p.id"
+)
+SQL_GET_PRODUCT_FULL = (
+    "SELECT p.*, bm.id AS bm_id, bm.title AS bm_title, bm.url AS bm_url "
+    "FROM products p LEFT JOIN buy_methods bm ON bm.product_id = p.id "
+    "WHERE p.id=? ORDER BY bm.pos, bm.id"
+)
+# порядок задаёт staff_list() по ROLE_RANK — строковый ORDER BY role сортировал бы по алфавиту
+SQL_STAFF_LIST = "SELECT user_id, role FROM staff"
+SQL_SET_ROLE = (
+    "INSERT INTO staff(user_id, role) VALUES(?,?) "
+    "ON CONFLICT(user_id) DO UPDATE SET role=excluded.role"
+)
+SQL_REMOVE_STAFF = "DELETE FROM staff WHERE user_id=?"
+# NULL = поле не меняется
+SQL_UPDATE_BUY_METHOD = "UPDATE buy_methods SET title=COALESCE(?, title), url=COALESCE(?, url) WHERE id=?"
+
+
 # -------------------- DB HELPERS --------------------
-async def db() -> aiosqlite.Connection:
-    conn = await aiosqlite.connect(DB_PATH)
-    await conn.execute("PRAGMA foreign_keys = ON;")
-    conn.row_factory = aiosqlite.Row
-    return conn
+# Выполняется один раз на каждое новое соединение пула.
+CONN_PRAGMAS = """
+PRAGMA foreign_keys = ON;
+PRAGMA synchronous = NORMAL;
+PRAGMA temp_store = MEMORY;
+PRAGMA cache_size = -64000;
+PRAGMA mmap_size = 134217728;
+PRAGMA busy_timeout = 10000;
+"""
+# per-connection кэш подготовленных запросов sqlite3 (по умолчанию 128)
+STATEMENT_CACHE_SIZE = 256
+
+
+class DBPool:
+    """Несколько соединений на чтение + одно соединение на запись.
+
+    Читатели берутся из очереди (до max_size штук, открываются по мере нужды),
+    писатель один и работает строго под локом — SQLite всё равно пишет
+    одним писателем, зато чтения из разных хендлеров идут параллельно.
+    """
+
+    def __init__(self, path: str, min_size: int = 2, max_size: int = 4):
+        self.path = path
+        self.min_size = min_size
+        self.max_size = max(min_size, max_size)
+        self._idle: asyncio.Queue = asyncio.Queue()
+        self._readers: List[aiosqlite.Connection] = []
+        self._grow_lock = asyncio.Lock()
+        self._writer: Optional[aiosqlite.Connection] = None
+        self._write_lock = asyncio.Lock()
+
+    async def _connect(self) -> aiosqlite.Connection:
+        conn = await aiosqlite.connect(self.path, cached_statements=STATEMENT_CACHE_SIZE)
+        await conn.executescript(CONN_PRAGMAS)
+        conn.row_factory = aiosqlite.Row
+        return conn
+
+    async def open(self):
+        if self._writer is not None:
+            return
+        self._writer = await self._connect()
+        # WAL хранится в самом файле БД — достаточно включить один раз
+        async with self._writer.execute("PRAGMA journal_mode = WAL;") as cur:
+            await cur.fetchone()
+        for _ in range(self.min_size):
+            conn = await self._connect()
+            self._readers.append(conn)
+            self._idle.put_nowait(conn)
+
+    async def close(self):
+        for conn in self._readers:
+            await conn.close()
+        self._readers.clear()
+        self._idle = asyncio.Queue()
+        if self._writer is not None:
+            await self._writer.close()
+            self._writer = None
+
+    async def _acquire(self) -> aiosqlite.Connection:
+        if self._idle.empty() and len(self._readers) < self.max_size:
+            async with self._grow_lock:
+                if self._idle.empty() and len(self._readers) < self.max_size:
+                    conn = await self._connect()
+                    self._readers.append(conn)
+                    return conn
+        return await self._idle.get()
+
+    @asynccontextmanager
+    async def reader(self) -> AsyncIterator[aiosqlite.Connection]:
+        conn = await self._acquire()
+        try:
+            yield conn
+        finally:
+            self._idle.put_nowait(conn)
+
+    @asynccontextmanager
+    async def writer(self) -> AsyncIterator[aiosqlite.Connection]:
+        async with self._write_lock:
+            try:
+                yield self._writer
+            except BaseException:
+                await self._writer.rollback()
+                raise
+
+
+pool = DBPool(DB_PATH, min_size=2, max_size=os.cpu_count() or 2)
+
+
+async def close_db():
+    await pool.close()
 
 
 DEFAULT_TEXTS: Dict[str, str] = {
@@ -80,11 +311,18 @@ ROLE_OWNER = "owner"
 ROLE_ADMIN = "admin"
 ROLE_MOD = "mod"
 ROLE_USER = "user"
+ROLE_RANK = {ROLE_USER: 0, ROLE_MOD: 1, ROLE_ADMIN: 2, ROLE_OWNER: 3}
+
+# Тексты меняются только через set_setting — кэш держим write-through без TTL.
+_SETTINGS: Dict[str, str] = {}
+# Персонал — несколько человек: вся таблица staff живёт в памяти (user_id -> role),
+# грузится в init_db и меняется только через staff_set_role/staff_remove.
+_STAFF: Dict[int, str] = {}
 
 
 async def init_db():
-    conn = await db()
-    try:
+    await pool.open()
+    async with pool.writer() as conn:
         await conn.executescript("""
         CREATE TABLE IF NOT EXISTS settings(
             key TEXT PRIMARY KEY,
@@ -127,69 +365,69 @@ async def init_db():
             url TEXT NOT NULL,
             pos INTEGER NOT NULL DEFAULT 0
         );
-        """)
-        await conn.commit()
 
-        # settings defaults
-        for k, v in DEFAULT_TEXTS.items():
-            await conn.execute(
-                "INSERT OR IGNORE INTO settings(key, value) VALUES(?,?)",
-                (k, v)
-            )
+        -- выборки по родителю с ORDER BY pos, id читаются прямо в порядке индекса
+        CREATE INDEX IF NOT EXISTS ix_sub_cat_pos ON subcategories(category_id, pos, id);
+        CREATE INDEX IF NOT EXISTS ix_prod_sub_pos ON products(subcategory_id, pos, id);
+        CREATE INDEX IF NOT EXISTS ix_bm_prod_pos ON buy_methods(product_id, pos, id);
+        """)
         await conn.commit()
 
-        # owner default
+        # settings defaults + owner default одной транзакцией;
+        # при обычном рестарте всё уже есть — тогда и коммитить нечего
+        before = conn.total_changes
+        await conn.executemany(
+            "INSERT OR IGNORE INTO settings(key, value) VALUES(?,?)",
+            DEFAULT_TEXTS.items()
+        )
         if OWNER_ID:
             await conn.execute(
                 "INSERT OR IGNORE INTO staff(user_id, role) VALUES(?,?)",
                 (OWNER_ID, ROLE_OWNER)
             )
+        if conn.total_changes != before:
             await conn.commit()
-    finally:
-        await conn.close()
+        else:
+            await conn.rollback()  # просто закрываем пустую транзакцию, без fsync
 
+        # статистика для планировщика; ANALYZE запустится, только если она устарела
+        await conn.execute("PRAGMA optimize")
 
-async def get_setting(key: str) -> str:
-    conn = await db()
-    try:
-        cur = await conn.execute("SELECT value FROM settings WHERE key=?", (key,))
-        row = await cur.fetchone()
-        return row["value"] if row else DEFAULT_TEXTS.get(key, "")
-    finally:
-        await conn.close()
+    async with pool.reader() as conn:
+        cur = await conn.execute("SELECT key, value FROM settings")
+        _SETTINGS.update({r["key"]: r["value"] for r in await cur.fetchall()})
+        cur = await conn.execute(SQL_STAFF_LIST)
+        _STAFF.update({r["user_id"]: r["role"] for r in await cur.fetchall()})
+
+
+def get_setting(key: str) -> str:
+    # вся таблица settings загружена в init_db, пишется только через set_setting
+    return _SETTINGS.get(key, DEFAULT_TEXTS.get(key, ""))
 
 
 async def set_setting(key: str, value: str):
-    conn = await db()
-    try:
-        await conn.execute(
-            "INSERT INTO settings(key,value) VALUES(?,?) "
-            "ON CONFLICT(key) DO UPDATE SET value=excluded.value",
-            (key, value)
-        )
+    async with pool.writer() as conn:
+        await conn.execute(SQL_SET_SETTING, (key, value))
         await conn.commit()
-    finally:
-        await conn.close()
+    _SETTINGS[key] = value
 
 
-async def get_staff_role(user_id: int) -> str:
+def get_staff_role(user_id: int) -> str:
     if OWNER_ID and user_id == OWNER_ID:
         return ROLE_OWNER
-    conn = await db()
-    try:
-        cur = await conn.execute("SELECT role FROM staff WHERE user_id=?", (user_id,))
-        row = await cur.fetchone()
-        return row["role"] if row else ROLE_USER
-    finally:
-        await conn.close()
+    return _STAFF.get(user_id, ROLE_USER)
 
 
 def role_at_least(role: str, min_role: str) -> bool:
-    order = {ROLE_USER: 0, ROLE_MOD: 1, ROLE_ADMIN: 2, ROLE_OWNER: 3}
-    return order.get(role, 0) >= order.get(min_role, 0)
+    return ROLE_RANK.get(role, 0) >= ROLE_RANK.get(min_role, 0)
 
 
 # -------------------- UI HELPERS --------------------
+# Статичные кнопки и клавиатуры собираем один раз: модели aiogram валидируются при каждом создании
+HOME_BTN = InlineKeyboardButton(text="🏠 В меню", callback_data="home")
+
+
+@functools.lru_cache(maxsize=2)
 def kb_home(is_admin: bool) -> InlineKeyboardMarkup:
     rows = [
         [InlineKeyboardButton(text="🛍️ Открыть магазин", callback_data="shop:home")],
@@ -200,111 +438,396 @@ def kb_home(is_admin: bool) -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(inline_keyboard=rows)
 
 
+@functools.lru_cache(maxsize=256)
 def kb_back(to: str = "shop:home") -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="⬅️ Назад", callback_data=to)],
-        [InlineKeyboardButton(text="🏠 В меню", callback_data="home")]
+        [HOME_BTN]
     ])
 
 
+@functools.lru_cache(maxsize=1)
 def kb_only_home() -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="🏠 В меню", callback_data="home")]
+        [HOME_BTN]
     ])
 
 
+# (chat_id, message_id) недавно удалённых — повторный тап не шлёт лишний deleteMessage
+_DELETED: deque = deque(maxlen=1024)
+
+
+async def safe_delete(msg: Message):
+    if not isinstance(msg, Message):
+        # InaccessibleMessage: старше 48 часов, удалить его бот уже не может
+        return
+    key = (msg.chat.id, msg.message_id)
+    if key in _DELETED:
+        return
+    _DELETED.append(key)
+    try:
+        await msg.delete()
+    except (TelegramBadRequest, TelegramNotFound):
+        # уже удалено / старше 48 часов
+        pass
+
+
 async def safe_edit_text(msg: Message, text: str, reply_markup: Optional[InlineKeyboardMarkup] = None):
+    if not isinstance(msg, Message):
+        # у колбэка на сообщение старше 48 часов приходит InaccessibleMessage — ни текста, ни разметки
+        await msg.answer(text, reply_markup=reply_markup)
+        return
+    if msg.content_type != ContentType.TEXT:
+        # edit_text у фото/видео Telegram всё равно отклонит — сразу шлём новое сообщение
+        await msg.answer(text, reply_markup=reply_markup)
+        await safe_delete(msg)
+        return
+    # повторный тап по той же кнопке: сообщение уже такое, Telegram ответил бы "message is not modified"
+    # (Telegram обрезает пробелы по краям, поэтому сравниваем со strip())
+    if msg.reply_markup == reply_markup and msg.html_text == text.strip():
+        return
     try:
         await msg.edit_text(text, reply_markup=reply_markup)
-    except Exception:
-        await msg.answer(text, reply_markup=reply_markup)
+    except TelegramBadRequest as e:
+        if "message is not modified" not in str(e):
+            await msg.answer(text, reply_markup=reply_markup)
+
+
+async def answer_media(msg: Message, media_type: str, file_id: str, caption: str,
+                       reply_markup: Optional[InlineKeyboardMarkup] = None):
+    if media_type == "photo":
+        await msg.answer_photo(file_id, caption=caption, reply_markup=reply_markup)
+    else:
+        await msg.answer_video(file_id, caption=caption, reply_markup=reply_markup)
+
+
+# -------------------- CATALOG CACHE --------------------
+# Каталог меняется редко, поэтому дерево и готовые клавиатуры держим в памяти.
+# Любая правка каталога вызывает catalog_changed() и сбрасывает кэш.
+CATALOG_TTL = 60.0
+# ключи строятся из id в колбэках, а их присылает клиент — кэш ограничен и вытесняет самые старые
+KB_CACHE_SIZE = 512
+_kb_cache: "OrderedDict[tuple, Tuple[float, InlineKeyboardMarkup]]" = OrderedDict()
+# product_id -> {(sub_id, cat_id): ProductCard}; кнопка «Назад» зависит от того, откуда пришли
+_PRODUCT_CARDS: Dict[int, Dict[Tuple[int, int], "ProductCard"]] = {}
+_catalog_version = 0
+
+
+def catalog_changed(patch: Optional[Callable[["CatalogTree"], None]] = None):
+    """patch — точечная правка закэшированного дерева (удаление узла), чтобы не перечитывать его из БД."""
+    global _catalog_version, _tree
+    _catalog_version += 1
+    if patch is not None and _tree is not None:
+        patch(_tree[1])
+    else:
+        _tree = None
+    _kb_cache.clear()
+    _PRODUCT_FULL.clear()
+    _PRODUCT_CARDS.clear()
+
+
+def product_changed(product_id: int):
+    """Правка одного товара или его способов покупки — клавиатуры каталога не трогаем."""
+    global _catalog_version
+    _catalog_version += 1
+    _PRODUCT_FULL.pop(product_id, None)
+    _PRODUCT_CARDS.pop(product_id, None)
+
+
+_INFLIGHT: Dict[tuple, asyncio.Future] = {}
+
+
+async def single_flight(key: tuple, fetch: Callable[[], Awaitable]):
+    """Одновременные промахи кэша по одному ключу ждут один и тот же запрос к БД.
+
+    В ключ входит _catalog_version — после правки каталога к старому запросу
+    уже никто не присоединится.
+    """
+    key = (*key, _catalog_version)
+    fut = _INFLIGHT.get(key)
+    if fut is None:
+        fut = asyncio.ensure_future(fetch())
+        _INFLIGHT[key] = fut
+        fut.add_done_callback(lambda _: _INFLIGHT.pop(key, None))
+    # shield: отмена одного ожидающего не должна рвать запрос остальным
+    return await asyncio.shield(fut)
 
 
 # -------------------- SHOP QUERIES --------------------
-async def list_categories() -> List[aiosqlite.Row]:
-    conn = await db()
-    try:
-        cur = await conn.execute("SELECT id, name FROM categories ORDER BY pos, id")
-        return await cur.fetchall()
-    finally:
-        await conn.close()
+@dataclass(frozen=True)
+class CatalogItem:
+    id: int
+    name: str
 
 
-async def list_subcategories(category_id: int) -> List[aiosqlite.Row]:
-    conn = await db()
-    try:
-        cur = await conn.execute(
-            "SELECT id, name FROM subcategories WHERE category_id=? ORDER BY pos, id",
-            (category_id,)
-        )
-        return await cur.fetchall()
-    finally:
-        await conn.close()
+@dataclass
+class CatalogTree:
+    categories: List[CatalogItem]
+    subcategories: Dict[int, List[CatalogItem]]  # category_id -> подкатегории
+    products: Dict[int, List[CatalogItem]]       # subcategory_id -> товары
 
+    def remove_category(self, cat_id: int):
+        self.categories = [c for c in self.categories if c.id != cat_id]
+        for sub in self.subcategories.pop(cat_id, []):
+            self.products.pop(sub.id, None)
 
-async def list_products(subcategory_id: int) -> List[aiosqlite.Row]:
-    conn = await db()
-    try:
-        cur = await conn.execute(
-            "SELECT id, name FROM products WHERE subcategory_id=? ORDER BY pos, id",
-            (subcategory_id,)
-        )
-        return await cur.fetchall()
-    finally:
-        await conn.close()
+    def remove_subcategory(self, sub_id: int, cat_id: int):
+        if cat_id in self.subcategories:
+            self.subcategories[cat_id] = [s for s in self.subcategories[cat_id] if s.id != sub_id]
+        self.products.pop(sub_id, None)
+
+    def remove_product(self, prod_id: int, sub_id: int):
+        if sub_id in self.products:
+            self.products[sub_id] = [p for p in self.products[sub_id] if p.id != prod_id]
+
+    def rename_category(self, cat_id: int, name: str):
+        self.categories = _renamed(self.categories, cat_id, name)
+
+    def rename_subcategory(self, sub_id: int, cat_id: int, name: str):
+        if cat_id in self.subcategories:
+            self.subcategories[cat_id] = _renamed(self.subcategories[cat_id], sub_id, name)
+
+    def rename_product(self, prod_id: int, sub_id: int, name: str):
+        if sub_id in self.products:
+            self.products[sub_id] = _renamed(self.products[sub_id], prod_id, name)
+
+    def has_product(self, prod_id: int, sub_id: int, cat_id: int) -> bool:
+        """Товар действительно лежит в этой подкатегории, а она — в этой категории."""
+        return (any(s.id == sub_id for s in self.subcategories.get(cat_id, ()))
+                and any(p.id == prod_id for p in self.products.get(sub_id, ())))
+
+
+def _renamed(items: List[CatalogItem], item_id: int, name: str) -> List[CatalogItem]:
+    return [CatalogItem(i.id, name) if i.id == item_id else i for i in items]
+
+
+_tree: Optional[Tuple[float, CatalogTree]] = None
+
+
+async def get_catalog_tree() -> CatalogTree:
+    """Весь каталог одним запросом вместо 1 + N + M выборок по уровням."""
+    if _tree is not None and _tree[0] > time.monotonic():
+        return _tree[1]
+    return await single_flight(("tree",), _load_catalog_tree)
+
+
+async def _load_catalog_tree() -> CatalogTree:
+    global _tree
+    version = _catalog_version
+    async with pool.reader() as conn:
+        cur = await conn.execute(SQL_CATALOG_TREE)
+        rows = await cur.fetchall()
+
+    tree = CatalogTree([], {}, {})
+    for r in rows:
+        cat_id, sub_id, prod_id = r["cat_id"], r["sub_id"], r["prod_id"]
+        if cat_id not in tree.subcategories:
+            tree.categories.append(CatalogItem(cat_id, r["cat_name"]))
+            tree.subcategories[cat_id] = []
+        if sub_id is None:
+            continue
+        if sub_id not in tree.products:
+            tree.subcategories[cat_id].append(CatalogItem(sub_id, r["sub_name"]))
+            tree.products[sub_id] = []
+        if prod_id is not None:
+            tree.products[sub_id].append(CatalogItem(prod_id, r["prod_name"]))
+
+    if version == _catalog_version:
+        _tree = (time.monotonic() + CATALOG_TTL, tree)
+    return tree
+
+
+async def list_categories() -> List[CatalogItem]:
+    return (await get_catalog_tree()).categories
+
+
+async def list_subcategories(category_id: int) -> List[CatalogItem]:
+    return (await get_catalog_tree()).subcategories.get(category_id, [])
+
+
+async def list_products(subcategory_id: int) -> List[CatalogItem]:
+    return (await get_catalog_tree()).products.get(subcategory_id, [])
 
 
 async def get_product(product_id: int) -> Optional[aiosqlite.Row]:
-    conn = await db()
-    try:
-        cur = await conn.execute("SELECT * FROM products WHERE id=?", (product_id,))
-        return await cur.fetchone()
-    finally:
-        await conn.close()
+    return (await get_product_full(product_id))[0]
 
 
-async def list_buy_methods(product_id: int) -> List[aiosqlite.Row]:
-    conn = await db()
-    try:
-        cur = await conn.execute(
-            "SELECT id, title, url FROM buy_methods WHERE product_id=? ORDER BY pos, id",
-            (product_id,)
-        )
-        return await cur.fetchall()
-    finally:
-        await conn.close()
+@dataclass(frozen=True)
+class BuyMethod:
+    id: int
+    title: str
+    url: str
+
+
+# product_id -> (товар, способы покупки); сбрасывается через product_changed()/catalog_changed()
+_PRODUCT_FULL: Dict[int, Tuple[aiosqlite.Row, List[BuyMethod]]] = {}
+
+
+async def get_product_full(product_id: int) -> Tuple[Optional[aiosqlite.Row], List[BuyMethod]]:
+    """Товар вместе со способами покупки — один LEFT JOIN вместо двух запросов."""
+    hit = _PRODUCT_FULL.get(product_id)
+    if hit is not None:
+        return hit
+    return await single_flight(("product", product_id), lambda: _load_product_full(product_id))
+
+
+async def _load_product_full(product_id: int) -> Tuple[Optional[aiosqlite.Row], List[BuyMethod]]:
+    version = _catalog_version
+    async with pool.reader() as conn:
+        cur = await conn.execute(SQL_GET_PRODUCT_FULL, (product_id,))
+        rows = await cur.fetchall()
+    if not rows:
+        return None, []
+    methods = [BuyMethod(r["bm_id"], r["bm_title"], r["bm_url"]) for r in rows if r["bm_id"] is not None]
+    result = (rows[0], methods)
+    if version == _catalog_version:
+        _PRODUCT_FULL[product_id] = result
+    return result
+
+
+# -------------------- CATALOG KEYBOARDS --------------------
+def cached_kb(build: Callable[..., Awaitable[Optional[InlineKeyboardMarkup]]]):
+    @functools.wraps(build)
+    async def wrapper(*args) -> Optional[InlineKeyboardMarkup]:
+        key = (build.__name__, *args)
+        now = time.monotonic()
+        hit = _kb_cache.get(key)
+        if hit is not None and hit[0] > now:
+            _kb_cache.move_to_end(key)
+            return hit[1]
+        version = _catalog_version
+        kb = await build(*args)
+        # None (несуществующий id) не кэшируем; если каталог поменялся, пока строили — тоже
+        if kb is not None and version == _catalog_version:
+            _kb_cache[key] = (now + CATALOG_TTL, kb)
+            _kb_cache.move_to_end(key)
+            if len(_kb_cache) > KB_CACHE_SIZE:
+                _kb_cache.popitem(last=False)
+        return kb
+    return wrapper
+
+
+@cached_kb
+async def kb_categories() -> Optional[InlineKeyboardMarkup]:
+    cats = await list_categories()
+    if not cats:
+        return None
+    rows = [[InlineKeyboardButton(text=r.name, callback_data=ShopCat(cat_id=r.id).pack())] for r in cats]
+    rows.append([HOME_BTN])
+    return InlineKeyboardMarkup(inline_keyboard=rows)
+
+
+@cached_kb
+async def kb_subcategories(cat_id: int) -> Optional[InlineKeyboardMarkup]:
+    subs = await list_subcategories(cat_id)
+    if not subs:
+        return None
+    rows = [[InlineKeyboardButton(text=r.name, callback_data=ShopSub(sub_id=r.id, cat_id=cat_id).pack())] for r in subs]
+    rows.append([InlineKeyboardButton(text="⬅️ Назад", callback_data="shop:home")])
+    rows.append([HOME_BTN])
+    return InlineKeyboardMarkup(inline_keyboard=rows)
+
+
+@cached_kb
+async def kb_products(sub_id: int, cat_id: int) -> Optional[InlineKeyboardMarkup]:
+    prods = await list_products(sub_id)
+    if not prods:
+        return None
+    rows = [[InlineKeyboardButton(text=r.name, callback_data=ShopProd(prod_id=r.id, sub_id=sub_id, cat_id=cat_id).pack())] for r in prods]
+    rows.append([InlineKeyboardButton(text="⬅️ Назад", callback_data=ShopCat(cat_id=cat_id).pack())])
+    rows.append([HOME_BTN])
+    return InlineKeyboardMarkup(inline_keyboard=rows)
+
+
+@cached_kb
+async def kb_adm_categories() -> InlineKeyboardMarkup:
+    cats = await list_categories()
+    rows = [[InlineKeyboardButton(text=r.name, callback_data=AdmCat(action="open", cat_id=r.id).pack())] for r in cats]
+    rows.append([InlineKeyboardButton(text="➕ Добавить категорию", callback_data="adm:cat_add")])
+    rows.append([InlineKeyboardButton(text="⬅️ Назад", callback_data="admin:home")])
+    return InlineKeyboardMarkup(inline_keyboard=rows)
+
+
+@cached_kb
+async def kb_adm_subcategories(cat_id: int) -> InlineKeyboardMarkup:
+    subs = await list_subcategories(cat_id)
+    rows = [[InlineKeyboardButton(text=s.name, callback_data=AdmSub(action="open", sub_id=s.id, cat_id=cat_id).pack())] for s in subs]
+    rows.append([InlineKeyboardButton(text="➕ Добавить подкатегорию", callback_data=AdmCat(action="sub_add", cat_id=cat_id).pack())])
+    rows.append([InlineKeyboardButton(text="✏️ Переименовать категорию", callback_data=AdmCat(action="edit", cat_id=cat_id).pack())])
+    rows.append([InlineKeyboardButton(text="🗑️ Удалить категорию", callback_data=AdmCat(action="del", cat_id=cat_id).pack())])
+    rows.append([InlineKeyboardButton(text="⬅️ Назад", callback_data="adm:cats")])
+    return InlineKeyboardMarkup(inline_keyboard=rows)
+
+
+@cached_kb
+async def kb_adm_products(sub_id: int, cat_id: int) -> InlineKeyboardMarkup:
+    prods = await list_products(sub_id)
+    rows = [[InlineKeyboardButton(text=p.name, callback_data=AdmProd(action="open", prod_id=p.id, sub_id=sub_id, cat_id=cat_id).pack())] for p in prods]
+    rows.append([InlineKeyboardButton(text="➕ Добавить товар", callback_data=AdmSub(action="prod_add", sub_id=sub_id, cat_id=cat_id).pack())])
+    rows.append([InlineKeyboardButton(text="✏️ Переименовать подкатегорию", callback_data=AdmSub(action="edit", sub_id=sub_id, cat_id=cat_id).pack())])
+    rows.append([InlineKeyboardButton(text="🗑️ Удалить подкатегорию", callback_data=AdmSub(action="del", sub_id=sub_id, cat_id=cat_id).pack())])
+    rows.append([InlineKeyboardButton(text="⬅️ Назад", callback_data=AdmCat(action="open", cat_id=cat_id).pack())])
+    return InlineKeyboardMarkup(inline_keyboard=rows)
+
+
+async def warm_catalog():
+    """Дерево и корневые клавиатуры собираем заранее, чтобы первый клик не ждал БД."""
+    await get_catalog_tree()
+    await asyncio.gather(kb_categories(), kb_adm_categories())
 
 
 # -------------------- ADMIN QUERIES --------------------
-async def staff_list() -> List[aiosqlite.Row]:
-    conn = await db()
-    try:
-        cur = await conn.execute("SELECT user_id, role FROM staff ORDER BY role DESC, user_id ASC")
-        return await cur.fetchall()
-    finally:
-        await conn.close()
+def staff_list() -> List[Tuple[int, str]]:
+    """Персонал из памяти: по старшинству роли (owner, admin, mod), внутри — по user_id.
+
+    Строковый role DESC давал owner, mod, admin — модераторы оказывались выше админов.
+    """
+    return sorted(_STAFF.items(), key=lambda kv: (-ROLE_RANK.get(kv[1], 0), kv[0]))
 
 
 async def staff_set_role(user_id: int, role: str):
-    conn = await db()
-    try:
-        await conn.execute(
-            "INSERT INTO staff(user_id, role) VALUES(?,?) "
-            "ON CONFLICT(user_id) DO UPDATE SET role=excluded.role",
-            (user_id, role)
-        )
+    async with pool.writer() as conn:
+        await conn.execute(SQL_SET_ROLE, (user_id, role))
         await conn.commit()
-    finally:
-        await conn.close()
+    _STAFF[user_id] = role
+    staff_text.cache_clear()
 
 
 async def staff_remove(user_id: int):
-    conn = await db()
-    try:
-        await conn.execute("DELETE FROM staff WHERE user_id=?", (user_id,))
+    async with pool.writer() as conn:
+        await conn.execute(SQL_REMOVE_STAFF, (user_id,))
+        await conn.commit()
+    _STAFF.pop(user_id, None)
+    staff_text.cache_clear()
+
+
+# Колонки products, которые можно менять через update_product_fields
+PRODUCT_FIELDS = frozenset({"name", "description", "price", "media_type", "media_file_id"})
+
+
+@functools.lru_cache(maxsize=64)
+def _product_update_sql(keys: Tuple[str, ...]) -> str:
+    return "UPDATE products SET " + ", ".join(f"{k}=?" for k in keys) + " WHERE id=? RETURNING subcategory_id"
+
+
+async def update_product_fields(product_id: int, **fields: str):
+    keys = tuple(sorted(fields))
+    unknown = set(keys) - PRODUCT_FIELDS
+    if unknown:
+        raise ValueError(f"unknown product fields: {', '.join(sorted(unknown))}")
+    async with pool.writer() as conn:
+        cur = await conn.execute(_product_update_sql(keys), [fields[k] for k in keys] + [product_id])
+        row = await cur.fetchone()
         await conn.commit()
-    finally:
-        await conn.close()
+    if "name" in fields:
+        # RETURNING отдаёт подкатегорию — переименовываем товар прямо в дереве, без перечитывания
+        if row:
+            catalog_changed(lambda tree: tree.rename_product(product_id, row["subcategory_id"], fields["name"]))
+        else:
+            catalog_changed()
+    else:
+        product_changed(product_id)
 
 
 # -------------------- STATES --------------------
@@ -364,187 +887,421 @@ class StaffAdd(StatesGroup):
     user_id = State()
 
 
+# -------------------- CALLBACK DATA --------------------
+class ShopCat(CallbackData, prefix="shop_cat"):
+    cat_id: int
+
+
+class ShopSub(CallbackData, prefix="shop_sub"):
+    sub_id: int
+    cat_id: int
+
+
+class ShopProd(CallbackData, prefix="shop_prod"):
+    prod_id: int
+    sub_id: int
+    cat_id: int
+
+
+class Buy(CallbackData, prefix="buy"):
+    prod_id: int
+    sub_id: int
+    cat_id: int
+
+
+# Админка: один класс на уровень каталога, действие — отдельным полем
+class AdmCat(CallbackData, prefix="adm_cat"):
+    action: str  # open / edit / del / sub_add
+    cat_id: int
+
+
+class AdmSub(CallbackData, prefix="adm_sub"):
+    action: str  # open / edit / del / prod_add
+    sub_id: int
+    cat_id: int
+
+
+class AdmProd(CallbackData, prefix="adm_prod"):
+    action: str  # open / del / name / desc / price / media / buy / buy_add
+    prod_id: int
+    sub_id: int
+    cat_id: int
+
+
+class AdmBuyMethod(CallbackData, prefix="adm_bm"):
+    method_id: int
+    prod_id: int
+    sub_id: int
+    cat_id: int
+
+
+class TextPick(CallbackData, prefix="txt"):
+    key: str
+
+
+class StaffRole(CallbackData, prefix="staff_role"):
+    role: str
+
+
+# -------------------- MIDDLEWARE --------------------
+class CallbackDebounce(BaseMiddleware):
+    """Повторный тап той же кнопки того же сообщения в пределах window секунд гасим сразу.
+
+    Стоит outer-мидлварью: дубль не проходит фильтры и не
+    трогает ни БД, ни editMessageText — только answerCallbackQuery, чтобы погас спиннер.
+    """
+
+    def __init__(self, window: float = 0.5, max_users: int = 10_000):
+        self.window = window
+        self.max_users = max_users
+        self._last: Dict[int, Tuple[Tuple[str, int], float]] = {}  # user_id -> ((data, message_id), monotonic)
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        if not isinstance(event, CallbackQuery):
+            return await handler(event, data)
+        now = time.monotonic()
+        key = (event.data or "", event.message.message_id if event.message else 0)
+        prev = self._last.get(event.from_user.id)
+        if prev is not None and prev[0] == key and now - prev[1] < self.window:
+            await event.answer()
+            return None
+        if len(self._last) >= self.max_users:
+            # старые отметки уже ничего не гасят — выкидываем их разом
+            self._last = {uid: v for uid, v in self._last.items() if now - v[1] < self.window}
+        self._last[event.from_user.id] = (key, now)
+        return await handler(event, data)
+
+
+class UserThrottle(BaseMiddleware):
+    """Token bucket на пользователя: в среднем rate апдейтов в секунду, всплеск до burst.
+
+    Лишнее отсекается до фильтров: колбэк получает «⏳», сообщение
+    молча игнорируется. Один флудящий пользователь не занимает пул БД и лимит Bot API.
+    Сообщения посреди FSM-диалога (ввод админки) не режем: выброшенный ввод
+    оставил бы диалог висеть без ответа.
+    """
+
+    def __init__(self, rate: float = 5.0, burst: int = 10, max_users: int = 10_000):
+        self.rate = rate
+        self.burst = burst
+        self.max_users = max_users
+        self._buckets: Dict[int, Tuple[float, float]] = {}  # user_id -> (tokens, monotonic)
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        user = data.get("event_from_user")
+        if user is None or (isinstance(event, Message) and data.get("raw_state") is not None):
+            return await handler(event, data)
+        now = time.monotonic()
+        tokens, ts = self._buckets.get(user.id, (float(self.burst), now))
+        tokens = min(self.burst, tokens + (now - ts) * self.rate)
+        if tokens < 1:
+            self._buckets[user.id] = (tokens, now)
+            if isinstance(event, CallbackQuery):
+                await event.answer("⏳")
+            return None
+        if len(self._buckets) >= self.max_users:
+            # полные вёдра ничем не отличаются от отсутствующих — выкидываем
+            full = self.burst / self.rate
+            self._buckets = {uid: b for uid, b in self._buckets.items() if now - b[1] < full}
+        self._buckets[user.id] = (tokens - 1, now)
+        return await handler(event, data)
+
+
+# текст отказа в алерте — по требуемому уровню
+DENY_TEXT = {ROLE_MOD: "⛔ Нет доступа", ROLE_ADMIN: "⛔ Нужно быть admin/owner"}
+
+
+class RoleGate(BaseMiddleware):
+    """Проверка прав по флагу обработчика: flags={"min_role": ROLE_MOD}.
+
+    Роль достаём один раз и кладём в data["role"] — обработчику она приходит
+    аргументом role. Без прав колбэк получает алерт, сообщение молча игнорируется.
+    """
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        min_role = get_flag(data, "min_role")
+        if min_role is None:
+            return await handler(event, data)
+        user = data.get("event_from_user")
+        role = get_staff_role(user.id) if user else ROLE_USER
+        if not role_at_least(role, min_role):
+            if isinstance(event, CallbackQuery):
+                await event.answer(DENY_TEXT.get(min_role, DENY_TEXT[ROLE_MOD]), show_alert=True)
+            return None
+        data["role"] = role
+        return await handler(event, data)
+
+
+# Где на ошибку нужен алерт, флаг MANUAL_ANSWER: обработчик отвечает сам, но до правок сообщения.
+MANUAL_ANSWER = {"manual_answer": True}
+
+
+class EarlyAnswer(BaseMiddleware):
+    """answerCallbackQuery уходит сразу и параллельно с обработчиком.
+
+    Спиннер гаснет через один round-trip, а не после походов в БД и правки сообщения.
+    """
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        if not isinstance(event, CallbackQuery) or get_flag(data, "manual_answer"):
+            return await handler(event, data)
+        ack = asyncio.ensure_future(event.answer())
+        try:
+            return await handler(event, data)
+        finally:
+            try:
+                await ack
+            except TelegramBadRequest as e:
+                # протухший query (старая кнопка после рестарта) — обработчик своё уже сделал
+                log.debug("callback answer failed: %s", e)
+            except Exception:
+                # сеть / retry-after: только логируем, иначе эта ошибка подменила бы исключение обработчика
+                log.warning("callback answer failed", exc_info=True)
+
+
+user_throttle = UserThrottle()
+for observer in (router.message, router.callback_query):
+    observer.outer_middleware(user_throttle)
+router.callback_query.outer_middleware(CallbackDebounce())
+
+role_gate = RoleGate()
+for observer in (router.message, router.callback_query):
+    observer.middleware(role_gate)
+# после RoleGate: отказ в правах уходит своим алертом, без второго ответа
+router.callback_query.middleware(EarlyAnswer())
+
+
 # -------------------- COMMANDS --------------------
 @router.message(CommandStart())
 async def cmd_start(m: Message):
-    role = await get_staff_role(m.from_user.id)
+    role, text = get_staff_role(m.from_user.id), get_setting("start_text")
     is_admin = role_at_least(role, ROLE_MOD)
-    text = await get_setting("start_text")
     await m.answer(text, reply_markup=kb_home(is_admin))
 
 
 @router.message(Command("admin"))
 async def cmd_admin(m: Message):
-    role = await get_staff_role(m.from_user.id)
+    role = get_staff_role(m.from_user.id)
     if not role_at_least(role, ROLE_MOD):
         return await m.answer("⛔ Доступ запрещён.")
     await m.answer("⚙️ Админ панель", reply_markup=admin_home_kb(role))
 
 
 # -------------------- GROUP WELCOME --------------------
+# Ссылка на бота: username известен только после get_me() в main()
+SHOP_URL = ""
+
+
+def set_shop_url(username: str):
+    global SHOP_URL
+    SHOP_URL = f"https://t.me/{username.lstrip('@')}"
+    open_shop_kb.cache_clear()
+
+
+# ключ — текст кнопки, так что после правки group_welcome_button просто соберётся новая
+@functools.lru_cache(maxsize=16)
 def open_shop_kb(btn_text: str) -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text=btn_text, url=f"https://t.me/{(bot.username or '').lstrip('@')}")]
+        [InlineKeyboardButton(text=btn_text, url=SHOP_URL)]
     ])
 
 
+# в одну группу Telegram пускает ~20 сообщений в минуту; лимитер на чат создаётся при первом вступлении.
+# Держим только последние GROUP_LIMITERS_MAX чатов: вытесненный чат давно молчал, его ведро и так полное.
+GROUP_RATE = 20 / 60
+GROUP_LIMITERS_MAX = 1024
+_group_limiters: "OrderedDict[int, RateLimiter]" = OrderedDict()
+
+
+def group_limiter(chat_id: int) -> RateLimiter:
+    limiter = _group_limiters.get(chat_id)
+    if limiter is None:
+        limiter = _group_limiters[chat_id] = RateLimiter(rate=GROUP_RATE, burst=20)
+        if len(_group_limiters) > GROUP_LIMITERS_MAX:
+            _group_limiters.popitem(last=False)
+    else:
+        _group_limiters.move_to_end(chat_id)
+    return limiter
+
+
 @router.message(F.new_chat_members)
 async def on_new_members(m: Message):
-    # Приветствие в группе
-    welcome = await get_setting("group_welcome_text")
-    btn_text = await get_setting("group_welcome_button")
-    await m.reply(welcome, reply_markup=open_shop_kb(btn_text))
+    # Приветствие в группе (одно на сервисное сообщение; если добавили только ботов — молчим)
+    if all(u.is_bot for u in m.new_chat_members):
+        return
+    welcome, btn_text = get_setting("group_welcome_text"), get_setting("group_welcome_button")
+    kb = open_shop_kb(btn_text)
+    await group_limiter(m.chat.id).acquire()
+    await m.reply(welcome, reply_markup=kb)
 
 
 # -------------------- MAIN HOME --------------------
 @router.callback_query(F.data == "home")
 async def cb_home(c: CallbackQuery):
-    role = await get_staff_role(c.from_user.id)
+    role, text = get_staff_role(c.from_user.id), get_setting("start_text")
     is_admin = role_at_least(role, ROLE_MOD)
-    text = await get_setting("start_text")
     await safe_edit_text(c.message, text, reply_markup=kb_home(is_admin))
-    await c.answer()
 
 
 @router.callback_query(F.data == "support")
 async def cb_support(c: CallbackQuery):
-    text = await get_setting("support_text")
+    text = get_setting("support_text")
     await safe_edit_text(c.message, text, reply_markup=kb_only_home())
-    await c.answer()
 
 
 # -------------------- SHOP FLOW --------------------
 @router.callback_query(F.data == "shop:home")
 async def shop_home(c: CallbackQuery):
-    cats = await list_categories()
-    if not cats:
-        await safe_edit_text(c.message, await get_setting("no_items"), reply_markup=kb_only_home())
-        return await c.answer()
-    rows = []
-    for r in cats:
-        rows.append([InlineKeyboardButton(text=r["name"], callback_data=f"shop:cat:{r['id']}")])
-    rows.append([InlineKeyboardButton(text="🏠 В меню", callback_data="home")])
-    kb = InlineKeyboardMarkup(inline_keyboard=rows)
-    await safe_edit_text(c.message, await get_setting("choose_category"), reply_markup=kb)
-    await c.answer()
-
-
-@router.callback_query(F.data.startswith("shop:cat:"))
-async def shop_category(c: CallbackQuery):
-    category_id = int(c.data.split(":")[-1])
-    subs = await list_subcategories(category_id)
-    if not subs:
-        await safe_edit_text(c.message, await get_setting("no_items"), reply_markup=kb_back("shop:home"))
-        return await c.answer()
-    rows = []
-    for r in subs:
-        rows.append([InlineKeyboardButton(text=r["name"], callback_data=f"shop:sub:{r['id']}:{category_id}")])
-    rows.append([InlineKeyboardButton(text="⬅️ Назад", callback_data="shop:home")])
-    rows.append([InlineKeyboardButton(text="🏠 В меню", callback_data="home")])
-    kb = InlineKeyboardMarkup(inline_keyboard=rows)
-    await safe_edit_text(c.message, await get_setting("choose_subcategory"), reply_markup=kb)
-    await c.answer()
+    kb = await kb_categories()
+    if kb is None:
+        await safe_edit_text(c.message, get_setting("no_items"), reply_markup=kb_only_home())
+        return
+    await safe_edit_text(c.message, get_setting("choose_category"), reply_markup=kb)
 
 
-@router.callback_query(F.data.startswith("shop:sub:"))
-async def shop_subcategory(c: CallbackQuery):
-    _, _, sub_id, cat_id = c.data.split(":")
-    sub_id = int(sub_id)
-    cat_id = int(cat_id)
-    prods = await list_products(sub_id)
-    if not prods:
-        await safe_edit_text(c.message, await get_setting("no_items"), reply_markup=kb_back(f"shop:cat:{cat_id}"))
-        return await c.answer()
-    rows = []
-    for r in prods:
-        rows.append([InlineKeyboardButton(text=r["name"], callback_data=f"shop:prod:{r['id']}:{sub_id}:{cat_id}")])
-    rows.append([InlineKeyboardButton(text="⬅️ Назад", callback_data=f"shop:cat:{cat_id}")])
-    rows.append([InlineKeyboardButton(text="🏠 В меню", callback_data="home")])
-    kb = InlineKeyboardMarkup(inline_keyboard=rows)
-    await safe_edit_text(c.message, await get_setting("choose_product"), reply_markup=kb)
-    await c.answer()
-
+@router.callback_query(ShopCat.filter())
+async def shop_category(c: CallbackQuery, callback_data: ShopCat):
+    kb = await kb_subcategories(callback_data.cat_id)
+    if kb is None:
+        await safe_edit_text(c.message, get_setting("no_items"), reply_markup=kb_back("shop:home"))
+        return
+    await safe_edit_text(c.message, get_setting("choose_subcategory"), reply_markup=kb)
 
-@router.callback_query(F.data.startswith("shop:prod:"))
-async def shop_product(c: CallbackQuery):
-    _, _, prod_id, sub_id, cat_id = c.data.split(":")
-    prod_id = int(prod_id)
-    sub_id = int(sub_id)
-    cat_id = int(cat_id)
 
-    p = await get_product(prod_id)
-    if not p:
-        await c.answer("Товар не найден", show_alert=True)
+@router.callback_query(ShopSub.filter())
+async def shop_subcategory(c: CallbackQuery, callback_data: ShopSub):
+    cat_id = callback_data.cat_id
+    kb = await kb_products(callback_data.sub_id, cat_id)
+    if kb is None:
+        await safe_edit_text(c.message, get_setting("no_items"), reply_markup=kb_back(ShopCat(cat_id=cat_id).pack()))
         return
+    await safe_edit_text(c.message, get_setting("choose_product"), reply_markup=kb)
+
+
+@dataclass(frozen=True)
+class ProductCard:
+    text: str
+    kb: InlineKeyboardMarkup
+    media_type: str
+    media_file_id: str
+    media: Optional[InputMedia]
+    buy_kb: Optional[InlineKeyboardMarkup]  # None — способы покупки не настроены
+
+
+async def get_product_card(prod_id: int, sub_id: int, cat_id: int) -> Optional[ProductCard]:
+    """Готовая карточка товара: текст, клавиатура и медиа собираются один раз до правки товара."""
+    key = (sub_id, cat_id)
+    hit = _PRODUCT_CARDS.get(prod_id, {}).get(key)
+    if hit is not None:
+        return hit
+    version = _catalog_version
+    p, methods = await get_product_full(prod_id)
+    if not p:
+        return None
 
-    name = p["name"]
-    desc = (p["description"] or "").strip()
-    price = (p["price"] or "").strip()
+    # поля товара — обычный текст из m.text; без экранирования «<» или «&» ломают HTML-разметку
+    name = html.escape(p["name"], quote=False)
+    desc = html.escape((p["description"] or "").strip(), quote=False)
+    price = html.escape((p["price"] or "").strip(), quote=False)
 
-    text = f"<b>{name}</b>\n"
+    parts = [f"<b>{name}</b>\n"]
     if price:
-        text += f"\n💰 <b>Цена:</b> {price}\n"
+        parts.append(f"\n💰 <b>Цена:</b> {price}\n")
     if desc:
-        text += f"\n📝 {desc}\n"
+        parts.append(f"\n📝 {desc}\n")
+    text = "".join(parts)
 
-    rows = [
-        [InlineKeyboardButton(text="✅ Купить", callback_data=f"buy:{prod_id}:{sub_id}:{cat_id}")],
-        [InlineKeyboardButton(text="⬅️ Назад", callback_data=f"shop:sub:{sub_id}:{cat_id}")],
-        [InlineKeyboardButton(text="🏠 В меню", callback_data="home")],
-    ]
-    kb = InlineKeyboardMarkup(inline_keyboard=rows)
+    kb = InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="✅ Купить", callback_data=Buy(prod_id=prod_id, sub_id=sub_id, cat_id=cat_id).pack())],
+        [InlineKeyboardButton(text="⬅️ Назад", callback_data=ShopSub(sub_id=sub_id, cat_id=cat_id).pack())],
+        [HOME_BTN],
+    ])
 
-    # если есть медиа — отправим/покажем
     media_type = (p["media_type"] or "").strip()
     media_file_id = (p["media_file_id"] or "").strip()
-
-    try:
-        if media_type == "photo" and media_file_id:
-            await c.message.edit_media(
-                media=InputMediaPhoto(media=media_file_id, caption=text, parse_mode=ParseMode.HTML),
-                reply_markup=kb
-            )
-        elif media_type == "video" and media_file_id:
-            await c.message.edit_media(
-                media=InputMediaVideo(media=media_file_id, caption=text, parse_mode=ParseMode.HTML),
-                reply_markup=kb
-            )
-        else:
-            await safe_edit_text(c.message, text, reply_markup=kb)
-    except Exception:
-        # если не получилось edit_media (например, предыдущее сообщение не медиа)
-        if media_type == "photo" and media_file_id:
-            await c.message.answer_photo(media_file_id, caption=text, reply_markup=kb)
-        elif media_type == "video" and media_file_id:
-            await c.message.answer_video(media_file_id, caption=text, reply_markup=kb)
-        else:
-            await c.message.answer(text, reply_markup=kb)
-
+    if media_type == "photo" and media_file_id:
+        media = InputMediaPhoto(media=media_file_id, caption=text, parse_mode=ParseMode.HTML)
+    elif media_type == "video" and media_file_id:
+        media = InputMediaVideo(media=media_file_id, caption=text, parse_mode=ParseMode.HTML)
+    else:
+        media = None
+
+    buy_kb = None
+    if methods:
+        rows = [[InlineKeyboardButton(text=m.title, url=m.url)] for m in methods]
+        back = ShopProd(prod_id=prod_id, sub_id=sub_id, cat_id=cat_id)
+        rows.append([InlineKeyboardButton(text="⬅️ Назад", callback_data=back.pack())])
+        rows.append([HOME_BTN])
+        buy_kb = InlineKeyboardMarkup(inline_keyboard=rows)
+
+    card = ProductCard(text, kb, media_type, media_file_id, media, buy_kb)
+    # sub_id/cat_id приходят из колбэка: кэшируем только настоящий путь по каталогу,
+    # иначе подделанные payload'ы плодили бы карточки под одним товаром
+    if version == _catalog_version and (await get_catalog_tree()).has_product(prod_id, sub_id, cat_id):
+        _PRODUCT_CARDS.setdefault(prod_id, {})[key] = card
+    return card
+
+
+@router.callback_query(ShopProd.filter(), flags=MANUAL_ANSWER)
+async def shop_product(c: CallbackQuery, callback_data: ShopProd):
+    prod_id, sub_id, cat_id = callback_data.prod_id, callback_data.sub_id, callback_data.cat_id
+    card = await get_product_card(prod_id, sub_id, cat_id)
+    if card is None:
+        await c.answer("Товар не найден", show_alert=True)
+        return
     await c.answer()
+    text, kb, media = card.text, card.kb, card.media
+    media_type, media_file_id = card.media_type, card.media_file_id
 
+    if media is None:
+        await safe_edit_text(c.message, text, reply_markup=kb)
+    elif isinstance(c.message, Message) and c.message.content_type in (ContentType.PHOTO, ContentType.VIDEO):
+        # медиа → медиа: хватает одного edit_media
+        try:
+            await c.message.edit_media(media=media, reply_markup=kb)
+        except TelegramBadRequest as e:
+            if "message is not modified" not in str(e):
+                await answer_media(c.message, media_type, media_file_id, text, reply_markup=kb)
+    else:
+        # текст → медиа: edit_media тут не сработает, сразу новое сообщение вместо старого
+        await answer_media(c.message, media_type, media_file_id, text, reply_markup=kb)
+        await safe_delete(c.message)
 
-@router.callback_query(F.data.startswith("buy:"))
-async def buy_menu(c: CallbackQuery):
-    _, prod_id, sub_id, cat_id = c.data.split(":")
-    prod_id = int(prod_id); sub_id = int(sub_id); cat_id = int(cat_id)
 
-    methods = await list_buy_methods(prod_id)
-    if not methods:
+@router.callback_query(Buy.filter(), flags=MANUAL_ANSWER)
+async def buy_menu(c: CallbackQuery, callback_data: Buy):
+    card = await get_product_card(callback_data.prod_id, callback_data.sub_id, callback_data.cat_id)
+    if card is None:
+        await c.answer("Товар не найден", show_alert=True)
+        return
+    if card.buy_kb is None:
         await c.answer("Способы покупки не настроены", show_alert=True)
         return
-
-    rows = []
-    for m in methods:
-        rows.append([InlineKeyboardButton(text=m["title"], url=m["url"])])
-    rows.append([InlineKeyboardButton(text="⬅️ Назад", callback_data=f"shop:prod:{prod_id}:{sub_id}:{cat_id}")])
-    rows.append([InlineKeyboardButton(text="🏠 В меню", callback_data="home")])
-    kb = InlineKeyboardMarkup(inline_keyboard=rows)
-
-    await safe_edit_text(c.message, "✅ Выберите способ покупки:", reply_markup=kb)
-    await c.answer()
+    await asyncio.gather(c.answer(), safe_edit_text(c.message, "✅ Выберите способ покупки:", reply_markup=card.buy_kb))
 
 
 # -------------------- ADMIN UI --------------------
+@functools.lru_cache(maxsize=4)
 def admin_home_kb(role: str) -> InlineKeyboardMarkup:
     rows = [
         [InlineKeyboardButton(text="📦 Категории", callback_data="adm:cats")],
@@ -552,51 +1309,38 @@ def admin_home_kb(role: str) -> InlineKeyboardMarkup:
     ]
     if role_at_least(role, ROLE_ADMIN):
         rows.append([InlineKeyboardButton(text="👥 Админы/модераторы", callback_data="adm:staff")])
-    rows.append([InlineKeyboardButton(text="🏠 В меню", callback_data="home")])
+    rows.append([HOME_BTN])
     return InlineKeyboardMarkup(inline_keyboard=rows)
 
 
-@router.callback_query(F.data == "admin:home")
-async def cb_admin_home(c: CallbackQuery):
-    role = await get_staff_role(c.from_user.id)
-    if not role_at_least(role, ROLE_MOD):
-        return await c.answer("⛔ Нет доступа", show_alert=True)
+@router.callback_query(F.data == "admin:home", flags={"min_role": ROLE_MOD})
+async def cb_admin_home(c: CallbackQuery, role: str):
     await safe_edit_text(c.message, "⚙️ Админ панель", reply_markup=admin_home_kb(role))
-    await c.answer()
 
 
 # -------------------- ADMIN: TEXTS --------------------
-@router.callback_query(F.data == "adm:texts")
-async def adm_texts(c: CallbackQuery, state: FSMContext):
-    role = await get_staff_role(c.from_user.id)
-    if not role_at_least(role, ROLE_MOD):
-        return await c.answer("⛔ Нет доступа", show_alert=True)
-
-    keys = [
-        ("start_text", "Стартовое сообщение"),
-        ("support_text", "Поддержка"),
-        ("group_welcome_text", "Приветствие в группе"),
-        ("group_welcome_button", "Текст кнопки приветствия"),
-    ]
+EDITABLE_TEXTS = (
+    ("start_text", "Стартовое сообщение"),
+    ("support_text", "Поддержка"),
+    ("group_welcome_text", "Приветствие в группе"),
+    ("group_welcome_button", "Текст кнопки приветствия"),
+)
+TEXTS_KB = InlineKeyboardMarkup(inline_keyboard=[
+    *([InlineKeyboardButton(text=title, callback_data=TextPick(key=k).pack())] for k, title in EDITABLE_TEXTS),
+    [InlineKeyboardButton(text="⬅️ Назад", callback_data="admin:home")],
+])
 
-    rows = []
-    for k, title in keys:
-        rows.append([InlineKeyboardButton(text=title, callback_data=f"txt:{k}")])
-    rows.append([InlineKeyboardButton(text="⬅️ Назад", callback_data="admin:home")])
-    kb = InlineKeyboardMarkup(inline_keyboard=rows)
-    await safe_edit_text(c.message, "✏️ Выберите текст для редактирования:", reply_markup=kb)
-    await c.answer()
 
+@router.callback_query(F.data == "adm:texts", flags={"min_role": ROLE_MOD})
+async def adm_texts(c: CallbackQuery, state: FSMContext):
+    await safe_edit_text(c.message, "✏️ Выберите текст для редактирования:", reply_markup=TEXTS_KB)
 
-@router.callback_query(F.data.startswith("txt:"))
-async def adm_text_pick(c: CallbackQuery, state: FSMContext):
-    role = await get_staff_role(c.from_user.id)
-    if not role_at_least(role, ROLE_MOD):
-        return await c.answer("⛔ Нет доступа", show_alert=True)
 
-    key = c.data.split(":", 1)[1]
-    cur = await get_setting(key)
-    await state.update_data(text_key=key)
+@router.callback_query(TextPick.filter(), flags={"min_role": ROLE_MOD})
+async def adm_text_pick(c: CallbackQuery, callback_data: TextPick, state: FSMContext):
+    key = callback_data.key
+    cur = get_setting(key)
+    await state.set_data({"text_key": key})
 
     await safe_edit_text(
         c.message,
@@ -605,15 +1349,10 @@ async def adm_text_pick(c: CallbackQuery, state: FSMContext):
         reply_markup=kb_back("adm:texts")
     )
     await state.set_state(EditTexts.value)
-    await c.answer()
 
 
-@router.message(EditTexts.value)
+@router.message(EditTexts.value, flags={"min_role": ROLE_MOD})
 async def adm_text_set(m: Message, state: FSMContext):
-    role = await get_staff_role(m.from_user.id)
-    if not role_at_least(role, ROLE_MOD):
-        return
-
     data = await state.get_data()
     key = data.get("text_key")
     if not key:
@@ -630,261 +1369,156 @@ async def adm_text_set(m: Message, state: FSMContext):
 
 
 # -------------------- ADMIN: CATEGORIES / SUBCATS / PRODUCTS --------------------
-@router.callback_query(F.data == "adm:cats")
+@router.callback_query(F.data == "adm:cats", flags={"min_role": ROLE_MOD})
 async def adm_cats(c: CallbackQuery):
-    role = await get_staff_role(c.from_user.id)
-    if not role_at_least(role, ROLE_MOD):
-        return await c.answer("⛔ Нет доступа", show_alert=True)
-
-    cats = await list_categories()
-    rows = []
-    for r in cats:
-        rows.append([InlineKeyboardButton(text=r["name"], callback_data=f"adm:cat:{r['id']}")])
-    rows.append([InlineKeyboardButton(text="➕ Добавить категорию", callback_data="adm:cat_add")])
-    rows.append([InlineKeyboardButton(text="⬅️ Назад", callback_data="admin:home")])
-    kb = InlineKeyboardMarkup(inline_keyboard=rows)
-
-    await safe_edit_text(c.message, "📦 Категории:", reply_markup=kb)
-    await c.answer()
+    await safe_edit_text(c.message, "📦 Категории:", reply_markup=await kb_adm_categories())
 
 
-@router.callback_query(F.data == "adm:cat_add")
+@router.callback_query(F.data == "adm:cat_add", flags={"min_role": ROLE_MOD})
 async def adm_cat_add(c: CallbackQuery, state: FSMContext):
-    role = await get_staff_role(c.from_user.id)
-    if not role_at_least(role, ROLE_MOD):
-        return await c.answer("⛔ Нет доступа", show_alert=True)
     await safe_edit_text(c.message, "Введите название новой категории:", reply_markup=kb_back("adm:cats"))
     await state.set_state(AdminAddCategory.name)
-    await c.answer()
 
 
-@router.message(AdminAddCategory.name)
+@router.message(AdminAddCategory.name, flags={"min_role": ROLE_MOD})
 async def adm_cat_add_save(m: Message, state: FSMContext):
-    role = await get_staff_role(m.from_user.id)
-    if not role_at_least(role, ROLE_MOD):
-        return
-
     name = (m.text or "").strip()
     if not name:
         return await m.answer("Введите название текстом.")
 
-    conn = await db()
-    try:
+    async with pool.writer() as conn:
         await conn.execute("INSERT INTO categories(name, pos) VALUES(?, 0)", (name,))
         await conn.commit()
-    finally:
-        await conn.close()
+    catalog_changed()
 
     await state.clear()
     await m.answer("✅ Категория добавлена. /admin")
 
 
-@router.callback_query(F.data.startswith("adm:cat:"))
-async def adm_cat_menu(c: CallbackQuery):
-    role = await get_staff_role(c.from_user.id)
-    if not role_at_least(role, ROLE_MOD):
-        return await c.answer("⛔ Нет доступа", show_alert=True)
-    cat_id = int(c.data.split(":")[-1])
-
-    subs = await list_subcategories(cat_id)
-    rows = []
-    for s in subs:
-        rows.append([InlineKeyboardButton(text=s["name"], callback_data=f"adm:sub:{s['id']}:{cat_id}")])
-
-    rows.append([InlineKeyboardButton(text="➕ Добавить подкатегорию", callback_data=f"adm:sub_add:{cat_id}")])
-    rows.append([InlineKeyboardButton(text="✏️ Переименовать категорию", callback_data=f"adm:cat_edit:{cat_id}")])
-    rows.append([InlineKeyboardButton(text="🗑️ Удалить категорию", callback_data=f"adm:cat_del:{cat_id}")])
-    rows.append([InlineKeyboardButton(text="⬅️ Назад", callback_data="adm:cats")])
-    kb = InlineKeyboardMarkup(inline_keyboard=rows)
-
-    await safe_edit_text(c.message, "📦 Категория → Подкатегории:", reply_markup=kb)
-    await c.answer()
+@router.callback_query(AdmCat.filter(F.action == "open"), flags={"min_role": ROLE_MOD})
+async def adm_cat_menu(c: CallbackQuery, callback_data: AdmCat):
+    cat_id = callback_data.cat_id
+    await safe_edit_text(c.message, "📦 Категория → Подкатегории:", reply_markup=await kb_adm_subcategories(cat_id))
 
 
-@router.callback_query(F.data.startswith("adm:cat_edit:"))
-async def adm_cat_edit(c: CallbackQuery, state: FSMContext):
-    role = await get_staff_role(c.from_user.id)
-    if not role_at_least(role, ROLE_MOD):
-        return await c.answer("⛔ Нет доступа", show_alert=True)
-    cat_id = int(c.data.split(":")[-1])
-    await state.update_data(category_id=cat_id)
-    await safe_edit_text(c.message, "Введите новое название категории:", reply_markup=kb_back(f"adm:cat:{cat_id}"))
+@router.callback_query(AdmCat.filter(F.action == "edit"), flags={"min_role": ROLE_MOD})
+async def adm_cat_edit(c: CallbackQuery, callback_data: AdmCat, state: FSMContext):
+    cat_id = callback_data.cat_id
+    await state.set_data({"category_id": cat_id})
+    await safe_edit_text(c.message, "Введите новое название категории:", reply_markup=kb_back(AdmCat(action="open", cat_id=cat_id).pack()))
     await state.set_state(AdminEditCategory.name)
-    await c.answer()
 
 
-@router.message(AdminEditCategory.name)
+@router.message(AdminEditCategory.name, flags={"min_role": ROLE_MOD})
 async def adm_cat_edit_save(m: Message, state: FSMContext):
-    role = await get_staff_role(m.from_user.id)
-    if not role_at_least(role, ROLE_MOD):
-        return
     data = await state.get_data()
     cat_id = int(data.get("category_id") or 0)
     name = (m.text or "").strip()
     if not cat_id or not name:
         await state.clear()
         return await m.answer("Ошибка.")
-    conn = await db()
-    try:
+    async with pool.writer() as conn:
         await conn.execute("UPDATE categories SET name=? WHERE id=?", (name, cat_id))
         await conn.commit()
-    finally:
-        await conn.close()
+    catalog_changed(lambda tree: tree.rename_category(cat_id, name))
     await state.clear()
     await m.answer("✅ Категория обновлена. /admin")
 
 
-@router.callback_query(F.data.startswith("adm:cat_del:"))
-async def adm_cat_del(c: CallbackQuery):
-    role = await get_staff_role(c.from_user.id)
-    if not role_at_least(role, ROLE_ADMIN):
-        return await c.answer("⛔ Нужно быть admin/owner", show_alert=True)
-    cat_id = int(c.data.split(":")[-1])
-
-    conn = await db()
-    try:
+@router.callback_query(AdmCat.filter(F.action == "del"), flags={"min_role": ROLE_ADMIN})
+async def adm_cat_del(c: CallbackQuery, callback_data: AdmCat):
+    cat_id = callback_data.cat_id
+    async with pool.writer() as conn:
         await conn.execute("DELETE FROM categories WHERE id=?", (cat_id,))
         await conn.commit()
-    finally:
-        await conn.close()
+    catalog_changed(lambda tree: tree.remove_category(cat_id))
 
-    await safe_edit_text(c.message, "🗑️ Категория удалена.", reply_markup=InlineKeyboardMarkup(
-        inline_keyboard=[[InlineKeyboardButton(text="⬅️ Назад", callback_data="adm:cats")]]
-    ))
-    await c.answer()
+    # сразу показываем родительский список — из поправленного кэша, без запроса в БД
+    await safe_edit_text(c.message, "🗑️ Категория удалена.\n\n📦 Категории:", reply_markup=await kb_adm_categories())
 
 
-@router.callback_query(F.data.startswith("adm:sub_add:"))
-async def adm_sub_add(c: CallbackQuery, state: FSMContext):
-    role = await get_staff_role(c.from_user.id)
-    if not role_at_least(role, ROLE_MOD):
-        return await c.answer("⛔ Нет доступа", show_alert=True)
-    cat_id = int(c.data.split(":")[-1])
-    await state.update_data(category_id=cat_id)
-    await safe_edit_text(c.message, "Введите название подкатегории:", reply_markup=kb_back(f"adm:cat:{cat_id}"))
+@router.callback_query(AdmCat.filter(F.action == "sub_add"), flags={"min_role": ROLE_MOD})
+async def adm_sub_add(c: CallbackQuery, callback_data: AdmCat, state: FSMContext):
+    cat_id = callback_data.cat_id
+    await state.set_data({"category_id": cat_id})
+    await safe_edit_text(c.message, "Введите название подкатегории:", reply_markup=kb_back(AdmCat(action="open", cat_id=cat_id).pack()))
     await state.set_state(AdminAddSubcategory.name)
-    await c.answer()
 
 
-@router.message(AdminAddSubcategory.name)
+@router.message(AdminAddSubcategory.name, flags={"min_role": ROLE_MOD})
 async def adm_sub_add_save(m: Message, state: FSMContext):
-    role = await get_staff_role(m.from_user.id)
-    if not role_at_least(role, ROLE_MOD):
-        return
     data = await state.get_data()
     cat_id = int(data.get("category_id") or 0)
     name = (m.text or "").strip()
     if not cat_id or not name:
         await state.clear()
         return await m.answer("Ошибка.")
-    conn = await db()
-    try:
+    async with pool.writer() as conn:
         await conn.execute("INSERT INTO subcategories(category_id, name, pos) VALUES(?,?,0)", (cat_id, name))
         await conn.commit()
-    finally:
-        await conn.close()
+    catalog_changed()
     await state.clear()
     await m.answer("✅ Подкатегория добавлена. /admin")
 
 
-@router.callback_query(F.data.startswith("adm:sub:"))
-async def adm_sub_menu(c: CallbackQuery):
-    role = await get_staff_role(c.from_user.id)
-    if not role_at_least(role, ROLE_MOD):
-        return await c.answer("⛔ Нет доступа", show_alert=True)
-
-    _, _, sub_id, cat_id = c.data.split(":")
-    sub_id = int(sub_id)
-    cat_id = int(cat_id)
-
-    prods = await list_products(sub_id)
-    rows = []
-    for p in prods:
-        rows.append([InlineKeyboardButton(text=p["name"], callback_data=f"adm:prod:{p['id']}:{sub_id}:{cat_id}")])
+@router.callback_query(AdmSub.filter(F.action == "open"), flags={"min_role": ROLE_MOD})
+async def adm_sub_menu(c: CallbackQuery, callback_data: AdmSub):
+    sub_id, cat_id = callback_data.sub_id, callback_data.cat_id
+    await safe_edit_text(c.message, "📁 Подкатегория → Товары:", reply_markup=await kb_adm_products(sub_id, cat_id))
 
-    rows.append([InlineKeyboardButton(text="➕ Добавить товар", callback_data=f"adm:prod_add:{sub_id}:{cat_id}")])
-    rows.append([InlineKeyboardButton(text="✏️ Переименовать подкатегорию", callback_data=f"adm:sub_edit:{sub_id}:{cat_id}")])
-    rows.append([InlineKeyboardButton(text="🗑️ Удалить подкатегорию", callback_data=f"adm:sub_del:{sub_id}:{cat_id}")])
-    rows.append([InlineKeyboardButton(text="⬅️ Назад", callback_data=f"adm:cat:{cat_id}")])
 
-    await safe_edit_text(c.message, "📁 Подкатегория → Товары:", reply_markup=InlineKeyboardMarkup(inline_keyboard=rows))
-    await c.answer()
-
-
-@router.callback_query(F.data.startswith("adm:sub_edit:"))
-async def adm_sub_edit(c: CallbackQuery, state: FSMContext):
-    role = await get_staff_role(c.from_user.id)
-    if not role_at_least(role, ROLE_MOD):
-        return await c.answer("⛔ Нет доступа", show_alert=True)
-
-    _, _, sub_id, cat_id = c.data.split(":")
-    await state.update_data(subcategory_id=int(sub_id), category_id=int(cat_id))
-    await safe_edit_text(c.message, "Введите новое название подкатегории:", reply_markup=kb_back(f"adm:sub:{sub_id}:{cat_id}"))
+@router.callback_query(AdmSub.filter(F.action == "edit"), flags={"min_role": ROLE_MOD})
+async def adm_sub_edit(c: CallbackQuery, callback_data: AdmSub, state: FSMContext):
+    sub_id, cat_id = callback_data.sub_id, callback_data.cat_id
+    await state.set_data({"subcategory_id": sub_id, "category_id": cat_id})
+    await safe_edit_text(c.message, "Введите новое название подкатегории:", reply_markup=kb_back(AdmSub(action="open", sub_id=sub_id, cat_id=cat_id).pack()))
     await state.set_state(AdminEditSubcategory.name)
-    await c.answer()
 
 
-@router.message(AdminEditSubcategory.name)
+@router.message(AdminEditSubcategory.name, flags={"min_role": ROLE_MOD})
 async def adm_sub_edit_save(m: Message, state: FSMContext):
-    role = await get_staff_role(m.from_user.id)
-    if not role_at_least(role, ROLE_MOD):
-        return
     data = await state.get_data()
     sub_id = int(data.get("subcategory_id") or 0)
     name = (m.text or "").strip()
     if not sub_id or not name:
         await state.clear()
         return await m.answer("Ошибка.")
-    conn = await db()
-    try:
-        await conn.execute("UPDATE subcategories SET name=? WHERE id=?", (name, sub_id))
+    async with pool.writer() as conn:
+        cur = await conn.execute("UPDATE subcategories SET name=? WHERE id=? RETURNING category_id", (name, sub_id))
+        row = await cur.fetchone()
         await conn.commit()
-    finally:
-        await conn.close()
+    if row:
+        catalog_changed(lambda tree: tree.rename_subcategory(sub_id, row["category_id"], name))
+    else:
+        catalog_changed()
     await state.clear()
     await m.answer("✅ Подкатегория обновлена. /admin")
 
 
-@router.callback_query(F.data.startswith("adm:sub_del:"))
-async def adm_sub_del(c: CallbackQuery):
-    role = await get_staff_role(c.from_user.id)
-    if not role_at_least(role, ROLE_ADMIN):
-        return await c.answer("⛔ Нужно быть admin/owner", show_alert=True)
-
-    _, _, sub_id, cat_id = c.data.split(":")
-    sub_id = int(sub_id); cat_id = int(cat_id)
-
-    conn = await db()
-    try:
+@router.callback_query(AdmSub.filter(F.action == "del"), flags={"min_role": ROLE_ADMIN})
+async def adm_sub_del(c: CallbackQuery, callback_data: AdmSub):
+    sub_id, cat_id = callback_data.sub_id, callback_data.cat_id
+    async with pool.writer() as conn:
         await conn.execute("DELETE FROM subcategories WHERE id=?", (sub_id,))
         await conn.commit()
-    finally:
-        await conn.close()
-
-    await safe_edit_text(c.message, "🗑️ Подкатегория удалена.", reply_markup=InlineKeyboardMarkup(
-        inline_keyboard=[[InlineKeyboardButton(text="⬅️ Назад", callback_data=f"adm:cat:{cat_id}")]]
-    ))
-    await c.answer()
+    catalog_changed(lambda tree: tree.remove_subcategory(sub_id, cat_id))
 
+    await safe_edit_text(
+        c.message, "🗑️ Подкатегория удалена.\n\n📦 Категория → Подкатегории:",
+        reply_markup=await kb_adm_subcategories(cat_id)
+    )
 
-@router.callback_query(F.data.startswith("adm:prod_add:"))
-async def adm_prod_add(c: CallbackQuery, state: FSMContext):
-    role = await get_staff_role(c.from_user.id)
-    if not role_at_least(role, ROLE_MOD):
-        return await c.answer("⛔ Нет доступа", show_alert=True)
 
-    _, _, sub_id, cat_id = c.data.split(":")
-    await state.update_data(subcategory_id=int(sub_id), category_id=int(cat_id))
-    await safe_edit_text(c.message, "Введите название товара:", reply_markup=kb_back(f"adm:sub:{sub_id}:{cat_id}"))
+@router.callback_query(AdmSub.filter(F.action == "prod_add"), flags={"min_role": ROLE_MOD})
+async def adm_prod_add(c: CallbackQuery, callback_data: AdmSub, state: FSMContext):
+    sub_id, cat_id = callback_data.sub_id, callback_data.cat_id
+    await state.set_data({"subcategory_id": sub_id, "category_id": cat_id})
+    await safe_edit_text(c.message, "Введите название товара:", reply_markup=kb_back(AdmSub(action="open", sub_id=sub_id, cat_id=cat_id).pack()))
     await state.set_state(AdminAddProduct.name)
-    await c.answer()
 
 
-@router.message(AdminAddProduct.name)
+@router.message(AdminAddProduct.name, flags={"min_role": ROLE_MOD})
 async def adm_prod_add_name(m: Message, state: FSMContext):
-    role = await get_staff_role(m.from_user.id)
-    if not role_at_least(role, ROLE_MOD):
-        return
     name = (m.text or "").strip()
     if not name:
         return await m.answer("Введите название.")
@@ -893,11 +1527,8 @@ async def adm_prod_add_name(m: Message, state: FSMContext):
     await state.set_state(AdminAddProduct.description)
 
 
-@router.message(AdminAddProduct.description)
+@router.message(AdminAddProduct.description, flags={"min_role": ROLE_MOD})
 async def adm_prod_add_desc(m: Message, state: FSMContext):
-    role = await get_staff_role(m.from_user.id)
-    if not role_at_least(role, ROLE_MOD):
-        return
     desc = (m.text or "").strip()
     if desc == "-":
         desc = ""
@@ -906,11 +1537,8 @@ async def adm_prod_add_desc(m: Message, state: FSMContext):
     await state.set_state(AdminAddProduct.price)
 
 
-@router.message(AdminAddProduct.price)
+@router.message(AdminAddProduct.price, flags={"min_role": ROLE_MOD})
 async def adm_prod_add_price(m: Message, state: FSMContext):
-    role = await get_staff_role(m.from_user.id)
-    if not role_at_least(role, ROLE_MOD):
-        return
     price = (m.text or "").strip()
     if price == "-":
         price = ""
@@ -919,15 +1547,10 @@ async def adm_prod_add_price(m: Message, state: FSMContext):
     await state.set_state(AdminAddProduct.media)
 
 
-@router.message(AdminAddProduct.media)
+@router.message(AdminAddProduct.media, flags={"min_role": ROLE_MOD})
 async def adm_prod_add_media(m: Message, state: FSMContext):
-    role = await get_staff_role(m.from_user.id)
-    if not role_at_least(role, ROLE_MOD):
-        return
-
     data = await state.get_data()
     sub_id = int(data.get("subcategory_id") or 0)
-    cat_id = int(data.get("category_id") or 0)
     name = data.get("name", "")
     desc = data.get("description", "")
     price = data.get("price", "")
@@ -946,122 +1569,100 @@ async def adm_prod_add_media(m: Message, state: FSMContext):
     else:
         return await m.answer("Пришлите фото/видео или '-'.")
 
-    conn = await db()
-    try:
-        cur = await conn.execute(
+    async with pool.writer() as conn:
+        await conn.execute(
             "INSERT INTO products(subcategory_id, name, description, price, media_type, media_file_id, pos) "
             "VALUES(?,?,?,?,?,?,0)",
             (sub_id, name, desc, price, media_type, media_file_id)
         )
-        prod_id = cur.lastrowid
         await conn.commit()
-    finally:
-        await conn.close()
+    catalog_changed()
 
     await state.clear()
-    await m.answer(f"✅ Товар добавлен.\nТеперь добавьте способы покупки: /admin\n(найдите товар и нажмите «Способы покупки»)")
+    await m.answer("✅ Товар добавлен.\nТеперь добавьте способы покупки: /admin\n(найдите товар и нажмите «Способы покупки»)")
 
 
-@router.callback_query(F.data.startswith("adm:prod:"))
-async def adm_prod_menu(c: CallbackQuery):
-    role = await get_staff_role(c.from_user.id)
-    if not role_at_least(role, ROLE_MOD):
-        return await c.answer("⛔ Нет доступа", show_alert=True)
+ADM_PROD_ACTIONS = (
+    ("🧾 Способы покупки", "buy"),
+    ("✏️ Изменить название", "name"),
+    ("✏️ Изменить описание", "desc"),
+    ("✏️ Изменить цену", "price"),
+    ("🖼️ Изменить медиа", "media"),
+    ("🗑️ Удалить товар", "del"),
+)
+
+
+# меню товара зависит только от id — от правок товара не меняется, кэш не сбрасываем
+@functools.lru_cache(maxsize=256)
+def adm_prod_kb(prod_id: int, sub_id: int, cat_id: int) -> InlineKeyboardMarkup:
+    rows = [
+        [InlineKeyboardButton(text=label, callback_data=AdmProd(action=action, prod_id=prod_id, sub_id=sub_id, cat_id=cat_id).pack())]
+        for label, action in ADM_PROD_ACTIONS
+    ]
+    rows.append([InlineKeyboardButton(text="⬅️ Назад", callback_data=AdmSub(action="open", sub_id=sub_id, cat_id=cat_id).pack())])
+    return InlineKeyboardMarkup(inline_keyboard=rows)
 
-    _, _, prod_id, sub_id, cat_id = c.data.split(":")
-    prod_id = int(prod_id); sub_id = int(sub_id); cat_id = int(cat_id)
 
+@router.callback_query(AdmProd.filter(F.action == "open"), flags={"min_role": ROLE_MOD, **MANUAL_ANSWER})
+async def adm_prod_menu(c: CallbackQuery, callback_data: AdmProd):
+    prod_id, sub_id, cat_id = callback_data.prod_id, callback_data.sub_id, callback_data.cat_id
     p = await get_product(prod_id)
     if not p:
         return await c.answer("Не найдено", show_alert=True)
+    await c.answer()
 
-    text = f"🛍️ <b>{p['name']}</b>\n\n"
+    parts = [f"🛍️ <b>{html.escape(p['name'], quote=False)}</b>\n\n"]
     if p["price"]:
-        text += f"💰 Цена: {p['price']}\n"
+        parts.append(f"💰 Цена: {html.escape(p['price'], quote=False)}\n")
     if p["description"]:
-        text += f"📝 {p['description']}\n"
+        parts.append(f"📝 {html.escape(p['description'], quote=False)}\n")
+    text = "".join(parts)
 
-    kb = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="🧾 Способы покупки", callback_data=f"adm:buy:{prod_id}:{sub_id}:{cat_id}")],
-        [InlineKeyboardButton(text="✏️ Изменить название", callback_data=f"adm:prod_edit_name:{prod_id}:{sub_id}:{cat_id}")],
-        [InlineKeyboardButton(text="✏️ Изменить описание", callback_data=f"adm:prod_edit_desc:{prod_id}:{sub_id}:{cat_id}")],
-        [InlineKeyboardButton(text="✏️ Изменить цену", callback_data=f"adm:prod_edit_price:{prod_id}:{sub_id}:{cat_id}")],
-        [InlineKeyboardButton(text="🖼️ Изменить медиа", callback_data=f"adm:prod_edit_media:{prod_id}:{sub_id}:{cat_id}")],
-        [InlineKeyboardButton(text="🗑️ Удалить товар", callback_data=f"adm:prod_del:{prod_id}:{sub_id}:{cat_id}")],
-        [InlineKeyboardButton(text="⬅️ Назад", callback_data=f"adm:sub:{sub_id}:{cat_id}")],
-    ])
+    kb = adm_prod_kb(prod_id, sub_id, cat_id)
 
     await safe_edit_text(c.message, text, reply_markup=kb)
-    await c.answer()
-
 
-@router.callback_query(F.data.startswith("adm:prod_del:"))
-async def adm_prod_del(c: CallbackQuery):
-    role = await get_staff_role(c.from_user.id)
-    if not role_at_least(role, ROLE_ADMIN):
-        return await c.answer("⛔ Нужно быть admin/owner", show_alert=True)
 
-    _, _, prod_id, sub_id, cat_id = c.data.split(":")
-    prod_id = int(prod_id); sub_id = int(sub_id); cat_id = int(cat_id)
-
-    conn = await db()
-    try:
+@router.callback_query(AdmProd.filter(F.action == "del"), flags={"min_role": ROLE_ADMIN})
+async def adm_prod_del(c: CallbackQuery, callback_data: AdmProd):
+    prod_id, sub_id, cat_id = callback_data.prod_id, callback_data.sub_id, callback_data.cat_id
+    async with pool.writer() as conn:
         await conn.execute("DELETE FROM products WHERE id=?", (prod_id,))
         await conn.commit()
-    finally:
-        await conn.close()
-
-    await safe_edit_text(c.message, "🗑️ Товар удалён.", reply_markup=InlineKeyboardMarkup(
-        inline_keyboard=[[InlineKeyboardButton(text="⬅️ Назад", callback_data=f"adm:sub:{sub_id}:{cat_id}")]]
-    ))
-    await c.answer()
+    catalog_changed(lambda tree: tree.remove_product(prod_id, sub_id))
 
+    await safe_edit_text(
+        c.message, "🗑️ Товар удалён.\n\n📁 Подкатегория → Товары:",
+        reply_markup=await kb_adm_products(sub_id, cat_id)
+    )
 
-@router.callback_query(F.data.startswith("adm:prod_edit_name:"))
-async def adm_prod_edit_name(c: CallbackQuery, state: FSMContext):
-    role = await get_staff_role(c.from_user.id)
-    if not role_at_least(role, ROLE_MOD):
-        return await c.answer("⛔ Нет доступа", show_alert=True)
 
-    _, _, _, prod_id, sub_id, cat_id = c.data.split(":")
-    await state.update_data(product_id=int(prod_id), sub_id=int(sub_id), cat_id=int(cat_id), field="name")
-    await safe_edit_text(c.message, "Введите новое название товара:", reply_markup=kb_back(f"adm:prod:{prod_id}:{sub_id}:{cat_id}"))
+@router.callback_query(AdmProd.filter(F.action == "name"), flags={"min_role": ROLE_MOD})
+async def adm_prod_edit_name(c: CallbackQuery, callback_data: AdmProd, state: FSMContext):
+    prod_id, sub_id, cat_id = callback_data.prod_id, callback_data.sub_id, callback_data.cat_id
+    await state.set_data({"product_id": prod_id, "sub_id": sub_id, "cat_id": cat_id, "field": "name"})
+    await safe_edit_text(c.message, "Введите новое название товара:", reply_markup=kb_back(AdmProd(action="open", prod_id=prod_id, sub_id=sub_id, cat_id=cat_id).pack()))
     await state.set_state(AdminEditProduct.value)
-    await c.answer()
-
 
-@router.callback_query(F.data.startswith("adm:prod_edit_desc:"))
-async def adm_prod_edit_desc(c: CallbackQuery, state: FSMContext):
-    role = await get_staff_role(c.from_user.id)
-    if not role_at_least(role, ROLE_MOD):
-        return await c.answer("⛔ Нет доступа", show_alert=True)
 
-    _, _, _, prod_id, sub_id, cat_id = c.data.split(":")
-    await state.update_data(product_id=int(prod_id), sub_id=int(sub_id), cat_id=int(cat_id), field="description")
-    await safe_edit_text(c.message, "Введите новое описание (или '-' чтобы очистить):", reply_markup=kb_back(f"adm:prod:{prod_id}:{sub_id}:{cat_id}"))
+@router.callback_query(AdmProd.filter(F.action == "desc"), flags={"min_role": ROLE_MOD})
+async def adm_prod_edit_desc(c: CallbackQuery, callback_data: AdmProd, state: FSMContext):
+    prod_id, sub_id, cat_id = callback_data.prod_id, callback_data.sub_id, callback_data.cat_id
+    await state.set_data({"product_id": prod_id, "sub_id": sub_id, "cat_id": cat_id, "field": "description"})
+    await safe_edit_text(c.message, "Введите новое описание (или '-' чтобы очистить):", reply_markup=kb_back(AdmProd(action="open", prod_id=prod_id, sub_id=sub_id, cat_id=cat_id).pack()))
     await state.set_state(AdminEditProduct.value)
-    await c.answer()
-
 
-@router.callback_query(F.data.startswith("adm:prod_edit_price:"))
-async def adm_prod_edit_price(c: CallbackQuery, state: FSMContext):
-    role = await get_staff_role(c.from_user.id)
-    if not role_at_least(role, ROLE_MOD):
-        return await c.answer("⛔ Нет доступа", show_alert=True)
 
-    _, _, _, prod_id, sub_id, cat_id = c.data.split(":")
-    await state.update_data(product_id=int(prod_id), sub_id=int(sub_id), cat_id=int(cat_id), field="price")
-    await safe_edit_text(c.message, "Введите новую цену (или '-' чтобы очистить):", reply_markup=kb_back(f"adm:prod:{prod_id}:{sub_id}:{cat_id}"))
+@router.callback_query(AdmProd.filter(F.action == "price"), flags={"min_role": ROLE_MOD})
+async def adm_prod_edit_price(c: CallbackQuery, callback_data: AdmProd, state: FSMContext):
+    prod_id, sub_id, cat_id = callback_data.prod_id, callback_data.sub_id, callback_data.cat_id
+    await state.set_data({"product_id": prod_id, "sub_id": sub_id, "cat_id": cat_id, "field": "price"})
+    await safe_edit_text(c.message, "Введите новую цену (или '-' чтобы очистить):", reply_markup=kb_back(AdmProd(action="open", prod_id=prod_id, sub_id=sub_id, cat_id=cat_id).pack()))
     await state.set_state(AdminEditProduct.value)
-    await c.answer()
 
 
-@router.message(AdminEditProduct.value)
+@router.message(AdminEditProduct.value, flags={"min_role": ROLE_MOD})
 async def adm_prod_edit_save(m: Message, state: FSMContext):
-    role = await get_staff_role(m.from_user.id)
-    if not role_at_least(role, ROLE_MOD):
-        return
-
     data = await state.get_data()
     prod_id = int(data.get("product_id") or 0)
     field = data.get("field")
@@ -1076,35 +1677,22 @@ async def adm_prod_edit_save(m: Message, state: FSMContext):
     if val == "-":
         val = ""
 
-    conn = await db()
-    try:
-        await conn.execute(f"UPDATE products SET {field}=? WHERE id=?", (val, prod_id))
-        await conn.commit()
-    finally:
-        await conn.close()
+    await update_product_fields(prod_id, **{field: val})
 
     await state.clear()
     await m.answer("✅ Обновлено. /admin")
 
 
-@router.callback_query(F.data.startswith("adm:prod_edit_media:"))
-async def adm_prod_edit_media(c: CallbackQuery, state: FSMContext):
-    role = await get_staff_role(c.from_user.id)
-    if not role_at_least(role, ROLE_MOD):
-        return await c.answer("⛔ Нет доступа", show_alert=True)
-
-    _, _, _, prod_id, sub_id, cat_id = c.data.split(":")
-    await state.update_data(product_id=int(prod_id), sub_id=int(sub_id), cat_id=int(cat_id))
-    await safe_edit_text(c.message, "Пришлите новое фото/видео (или '-' чтобы удалить медиа):", reply_markup=kb_back(f"adm:prod:{prod_id}:{sub_id}:{cat_id}"))
+@router.callback_query(AdmProd.filter(F.action == "media"), flags={"min_role": ROLE_MOD})
+async def adm_prod_edit_media(c: CallbackQuery, callback_data: AdmProd, state: FSMContext):
+    prod_id, sub_id, cat_id = callback_data.prod_id, callback_data.sub_id, callback_data.cat_id
+    await state.set_data({"product_id": prod_id, "sub_id": sub_id, "cat_id": cat_id})
+    await safe_edit_text(c.message, "Пришлите новое фото/видео (или '-' чтобы удалить медиа):", reply_markup=kb_back(AdmProd(action="open", prod_id=prod_id, sub_id=sub_id, cat_id=cat_id).pack()))
     await state.set_state(AdminEditProduct.media)
-    await c.answer()
 
 
-@router.message(AdminEditProduct.media)
+@router.message(AdminEditProduct.media, flags={"min_role": ROLE_MOD})
 async def adm_prod_edit_media_save(m: Message, state: FSMContext):
-    role = await get_staff_role(m.from_user.id)
-    if not role_at_least(role, ROLE_MOD):
-        return
     data = await state.get_data()
     prod_id = int(data.get("product_id") or 0)
     if not prod_id:
@@ -1124,59 +1712,41 @@ async def adm_prod_edit_media_save(m: Message, state: FSMContext):
     else:
         return await m.answer("Пришлите фото/видео или '-'.")
 
-    conn = await db()
-    try:
-        await conn.execute(
-            "UPDATE products SET media_type=?, media_file_id=? WHERE id=?",
-            (media_type, media_file_id, prod_id)
-        )
-        await conn.commit()
-    finally:
-        await conn.close()
+    await update_product_fields(prod_id, media_type=media_type, media_file_id=media_file_id)
 
     await state.clear()
     await m.answer("✅ Медиа обновлено. /admin")
 
 
 # -------------------- ADMIN: BUY METHODS --------------------
-@router.callback_query(F.data.startswith("adm:buy:"))
-async def adm_buy_list(c: CallbackQuery):
-    role = await get_staff_role(c.from_user.id)
-    if not role_at_least(role, ROLE_MOD):
-        return await c.answer("⛔ Нет доступа", show_alert=True)
+# кнопка-ссылка Telegram принимает только эти схемы
+BUY_URL_SCHEMES = ("http://", "https://", "tg://")
 
-    _, _, prod_id, sub_id, cat_id = c.data.split(":")
-    prod_id = int(prod_id); sub_id = int(sub_id); cat_id = int(cat_id)
 
-    methods = await list_buy_methods(prod_id)
-    rows = []
-    for mth in methods:
-        rows.append([InlineKeyboardButton(text=f"✏️ {mth['title']}", callback_data=f"adm:buy_edit:{mth['id']}:{prod_id}:{sub_id}:{cat_id}")])
-    rows.append([InlineKeyboardButton(text="➕ Добавить способ", callback_data=f"adm:buy_add:{prod_id}:{sub_id}:{cat_id}")])
-    rows.append([InlineKeyboardButton(text="⬅️ Назад", callback_data=f"adm:prod:{prod_id}:{sub_id}:{cat_id}")])
+@router.callback_query(AdmProd.filter(F.action == "buy"), flags={"min_role": ROLE_MOD})
+async def adm_buy_list(c: CallbackQuery, callback_data: AdmProd):
+    prod_id, sub_id, cat_id = callback_data.prod_id, callback_data.sub_id, callback_data.cat_id
+    _, methods = await get_product_full(prod_id)
+    rows = [
+        [InlineKeyboardButton(text=f"✏️ {mth.title}", callback_data=AdmBuyMethod(method_id=mth.id, prod_id=prod_id, sub_id=sub_id, cat_id=cat_id).pack())]
+        for mth in methods
+    ]
+    rows.append([InlineKeyboardButton(text="➕ Добавить способ", callback_data=AdmProd(action="buy_add", prod_id=prod_id, sub_id=sub_id, cat_id=cat_id).pack())])
+    rows.append([InlineKeyboardButton(text="⬅️ Назад", callback_data=AdmProd(action="open", prod_id=prod_id, sub_id=sub_id, cat_id=cat_id).pack())])
 
     await safe_edit_text(c.message, "🧾 Способы покупки:", reply_markup=InlineKeyboardMarkup(inline_keyboard=rows))
-    await c.answer()
 
 
-@router.callback_query(F.data.startswith("adm:buy_add:"))
-async def adm_buy_add(c: CallbackQuery, state: FSMContext):
-    role = await get_staff_role(c.from_user.id)
-    if not role_at_least(role, ROLE_MOD):
-        return await c.answer("⛔ Нет доступа", show_alert=True)
-
-    _, _, prod_id, sub_id, cat_id = c.data.split(":")
-    await state.update_data(product_id=int(prod_id), sub_id=int(sub_id), cat_id=int(cat_id))
-    await safe_edit_text(c.message, "Введите название кнопки (например: 'Оплатить картой'):", reply_markup=kb_back(f"adm:buy:{prod_id}:{sub_id}:{cat_id}"))
+@router.callback_query(AdmProd.filter(F.action == "buy_add"), flags={"min_role": ROLE_MOD})
+async def adm_buy_add(c: CallbackQuery, callback_data: AdmProd, state: FSMContext):
+    prod_id, sub_id, cat_id = callback_data.prod_id, callback_data.sub_id, callback_data.cat_id
+    await state.set_data({"product_id": prod_id, "sub_id": sub_id, "cat_id": cat_id})
+    await safe_edit_text(c.message, "Введите название кнопки (например: 'Оплатить картой'):", reply_markup=kb_back(AdmProd(action="buy", prod_id=prod_id, sub_id=sub_id, cat_id=cat_id).pack()))
     await state.set_state(AdminAddBuyMethod.title)
-    await c.answer()
 
 
-@router.message(AdminAddBuyMethod.title)
+@router.message(AdminAddBuyMethod.title, flags={"min_role": ROLE_MOD})
 async def adm_buy_add_title(m: Message, state: FSMContext):
-    role = await get_staff_role(m.from_user.id)
-    if not role_at_least(role, ROLE_MOD):
-        return
     title = (m.text or "").strip()
     if not title:
         return await m.answer("Введите название.")
@@ -1185,175 +1755,159 @@ async def adm_buy_add_title(m: Message, state: FSMContext):
     await state.set_state(AdminAddBuyMethod.url)
 
 
-@router.message(AdminAddBuyMethod.url)
+@router.message(AdminAddBuyMethod.url, flags={"min_role": ROLE_MOD})
 async def adm_buy_add_url(m: Message, state: FSMContext):
-    role = await get_staff_role(m.from_user.id)
-    if not role_at_least(role, ROLE_MOD):
-        return
     data = await state.get_data()
     prod_id = int(data.get("product_id") or 0)
     title = data.get("title", "")
     url = (m.text or "").strip()
-    if not (prod_id and title and url.startswith(("http://", "https://", "tg://"))):
+    if not (prod_id and title and url.startswith(BUY_URL_SCHEMES)):
         return await m.answer("Нужна ссылка, начинающаяся с http:// или https:// (или tg://).")
 
-    conn = await db()
-    try:
+    async with pool.writer() as conn:
         await conn.execute(
             "INSERT INTO buy_methods(product_id, title, url, pos) VALUES(?,?,?,0)",
             (prod_id, title, url)
         )
         await conn.commit()
-    finally:
-        await conn.close()
+    product_changed(prod_id)
 
     await state.clear()
     await m.answer("✅ Способ покупки добавлен. /admin")
 
 
-@router.callback_query(F.data.startswith("adm:buy_edit:"))
-async def adm_buy_edit(c: CallbackQuery, state: FSMContext):
-    role = await get_staff_role(c.from_user.id)
-    if not role_at_least(role, ROLE_MOD):
-        return await c.answer("⛔ Нет доступа", show_alert=True)
-
-    _, _, mid, prod_id, sub_id, cat_id = c.data.split(":")
-    mid = int(mid)
-
-    conn = await db()
-    try:
-        cur = await conn.execute("SELECT id, title, url FROM buy_methods WHERE id=?", (mid,))
-        row = await cur.fetchone()
-    finally:
-        await conn.close()
+@router.callback_query(AdmBuyMethod.filter(), flags={"min_role": ROLE_MOD, **MANUAL_ANSWER})
+async def adm_buy_edit(c: CallbackQuery, callback_data: AdmBuyMethod, state: FSMContext):
+    mid, prod_id, sub_id, cat_id = (
+        callback_data.method_id, callback_data.prod_id, callback_data.sub_id, callback_data.cat_id
+    )
+    # способы уже лежат в кэше товара вместе с ним — отдельный SELECT не нужен
+    _, methods = await get_product_full(prod_id)
+    row = next((mth for mth in methods if mth.id == mid), None)
 
     if not row:
         return await c.answer("Не найдено", show_alert=True)
+    await c.answer()
 
-    await state.update_data(method_id=mid, prod_id=int(prod_id), sub_id=int(sub_id), cat_id=int(cat_id))
+    await state.set_data({"method_id": mid, "prod_id": prod_id, "sub_id": sub_id, "cat_id": cat_id})
     await safe_edit_text(
         c.message,
-        f"Текущий способ:\n<b>{row['title']}</b>\n{row['url']}\n\n"
-        "Отправьте новое название (или '-' чтобы оставить):",
-        reply_markup=kb_back(f"adm:buy:{prod_id}:{sub_id}:{cat_id}")
+        f"Текущий способ:\n<b>{html.escape(row.title, quote=False)}</b>\n{html.escape(row.url, quote=False)}\n\n"
+        "Отправьте новое название (или '-' чтобы оставить).\n"
+        "Название и URL сохраняются вместе — после шага с URL:",
+        reply_markup=kb_back(AdmProd(action="buy", prod_id=prod_id, sub_id=sub_id, cat_id=cat_id).pack())
     )
     await state.set_state(AdminEditBuyMethod.title)
-    await c.answer()
 
 
-@router.message(AdminEditBuyMethod.title)
+@router.message(AdminEditBuyMethod.title, flags={"min_role": ROLE_MOD})
 async def adm_buy_edit_title(m: Message, state: FSMContext):
-    role = await get_staff_role(m.from_user.id)
-    if not role_at_least(role, ROLE_MOD):
-        return
-
     data = await state.get_data()
     mid = int(data.get("method_id") or 0)
     if not mid:
         await state.clear()
         return await m.answer("Ошибка состояния.")
 
+    # пишем в БД один раз — вместе с URL на следующем шаге; бросил правку на URL — название не меняется
     title = (m.text or "").strip()
-    if title != "-":
-        conn = await db()
-        try:
-            await conn.execute("UPDATE buy_methods SET title=? WHERE id=?", (title, mid))
-            await conn.commit()
-        finally:
-            await conn.close()
+    await state.update_data(title=None if title == "-" else title)
 
-    await m.answer("Теперь отправьте новый URL (или '-' чтобы оставить):")
+    await m.answer("Теперь отправьте новый URL (или '-' чтобы оставить) — после него изменения сохранятся:")
     await state.set_state(AdminEditBuyMethod.url)
 
 
-@router.message(AdminEditBuyMethod.url)
+@router.message(AdminEditBuyMethod.url, flags={"min_role": ROLE_MOD})
 async def adm_buy_edit_url(m: Message, state: FSMContext):
-    role = await get_staff_role(m.from_user.id)
-    if not role_at_least(role, ROLE_MOD):
-        return
-
     data = await state.get_data()
     mid = int(data.get("method_id") or 0)
     url = (m.text or "").strip()
 
-    if url != "-":
-        if not url.startswith(("http://", "https://", "tg://")):
-            return await m.answer("Нужна ссылка http:// или https:// (или tg://).")
-        conn = await db()
-        try:
-            await conn.execute("UPDATE buy_methods SET url=? WHERE id=?", (url, mid))
+    if url == "-":
+        url = None
+    elif not url.startswith(BUY_URL_SCHEMES):
+        return await m.answer("Нужна ссылка http:// или https:// (или tg://).")
+
+    title = data.get("title")
+    if title is not None or url is not None:
+        async with pool.writer() as conn:
+            await conn.execute(SQL_UPDATE_BUY_METHOD, (title, url, mid))
             await conn.commit()
-        finally:
-            await conn.close()
+        product_changed(int(data.get("prod_id") or 0))
 
     await state.clear()
     await m.answer("✅ Способ покупки обновлён. /admin")
 
 
 # -------------------- ADMIN: STAFF (OWNER/ADMIN can) --------------------
-@router.callback_query(F.data == "adm:staff")
-async def adm_staff(c: CallbackQuery, state: FSMContext):
-    role = await get_staff_role(c.from_user.id)
-    if not role_at_least(role, ROLE_ADMIN):
-        return await c.answer("⛔ Нужно быть admin/owner", show_alert=True)
-
-    rows = await staff_list()
-    text = "👥 <b>Сотрудники</b>:\n\n"
+STAFF_KB = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text="➕ Добавить", callback_data="staff:add")],
+    [InlineKeyboardButton(text="➖ Удалить", callback_data="staff:remove")],
+    [InlineKeyboardButton(text="⬅️ Назад", callback_data="admin:home")],
+])
+STAFF_ROLE_KB = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text="admin", callback_data=StaffRole(role=ROLE_ADMIN).pack())],
+    [InlineKeyboardButton(text="mod", callback_data=StaffRole(role=ROLE_MOD).pack())],
+    [InlineKeyboardButton(text="⬅️ Назад", callback_data="adm:staff")],
+])
+
+
+# текст списка собирается один раз; staff_set_role/staff_remove сбрасывают кэш
+@functools.lru_cache(maxsize=1)
+def staff_text() -> str:
+    rows = staff_list()
     if not rows:
-        text += "Пока никого нет."
-    else:
-        for r in rows:
-            text += f"• <code>{r['user_id']}</code> — <b>{r['role']}</b>\n"
+        return "👥 <b>Сотрудники</b>:\n\nПока никого нет."
+    body = "".join(f"• <code>{user_id}</code> — <b>{role}</b>\n" for user_id, role in rows)
+    return f"👥 <b>Сотрудники</b>:\n\n{body}"
 
-    kb = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="➕ Добавить", callback_data="staff:add")],
-        [InlineKeyboardButton(text="➖ Удалить", callback_data="staff:remove")],
-        [InlineKeyboardButton(text="⬅️ Назад", callback_data="admin:home")],
-    ])
-    await safe_edit_text(c.message, text, reply_markup=kb)
-    await c.answer()
 
+@router.callback_query(F.data == "adm:staff", flags={"min_role": ROLE_ADMIN})
+async def adm_staff(c: CallbackQuery, state: FSMContext):
+    await safe_edit_text(c.message, staff_text(), reply_markup=STAFF_KB)
 
-@router.callback_query(F.data == "staff:add")
-async def staff_add_start(c: CallbackQuery, state: FSMContext):
-    role = await get_staff_role(c.from_user.id)
-    if not role_at_least(role, ROLE_ADMIN):
-        return await c.answer("⛔ Нужно быть admin/owner", show_alert=True)
 
-    kb = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="admin", callback_data="staff:role:admin")],
-        [InlineKeyboardButton(text="mod", callback_data="staff:role:mod")],
-        [InlineKeyboardButton(text="⬅️ Назад", callback_data="adm:staff")],
-    ])
-    await safe_edit_text(c.message, "Выберите роль:", reply_markup=kb)
+@router.callback_query(F.data == "staff:add", flags={"min_role": ROLE_ADMIN})
+async def staff_add_start(c: CallbackQuery, state: FSMContext):
+    await safe_edit_text(c.message, "Выберите роль:", reply_markup=STAFF_ROLE_KB)
     await state.set_state(StaffAdd.role)
-    await c.answer()
 
 
-@router.callback_query(F.data.startswith("staff:role:"))
-async def staff_add_role(c: CallbackQuery, state: FSMContext):
-    role = await get_staff_role(c.from_user.id)
-    if not role_at_least(role, ROLE_ADMIN):
-        return await c.answer("⛔ Нужно быть admin/owner", show_alert=True)
-
-    new_role = c.data.split(":")[-1]
-    await state.update_data(new_role=new_role)
+# через кнопку можно выдать только admin/mod — подделанный колбэк с owner не пройдёт фильтр
+@router.callback_query(StaffRole.filter(F.role.in_({ROLE_ADMIN, ROLE_MOD})), flags={"min_role": ROLE_ADMIN})
+async def staff_add_role(c: CallbackQuery, callback_data: StaffRole, state: FSMContext):
+    await state.set_data({"new_role": callback_data.role})
     await safe_edit_text(c.message, "Отправьте user_id человека (число).", reply_markup=kb_back("adm:staff"))
     await state.set_state(StaffAdd.user_id)
-    await c.answer()
 
 
-@router.message(StaffAdd.user_id)
-async def staff_add_finish(m: Message, state: FSMContext):
-    role = await get_staff_role(m.from_user.id)
-    if not role_at_least(role, ROLE_ADMIN):
-        return
+def parse_user_id(text: Optional[str]) -> Optional[int]:
+    """user_id из сообщения или None. Больше 2**63-1 sqlite3 не примет — отсекаем заранее."""
+    try:
+        uid = int((text or "").strip())
+    except ValueError:
+        return None
+    return uid if 0 < uid < 2 ** 63 else None
+
+
+@router.callback_query(F.data == "staff:remove", flags={"min_role": ROLE_ADMIN})
+async def staff_remove_start(c: CallbackQuery, state: FSMContext):
+    await safe_edit_text(c.message, "Отправьте user_id, которого удалить из staff:", reply_markup=kb_back("adm:staff"))
+    await state.set_state(StaffAdd.user_id)
+    await state.set_data({"remove_mode": True})
+
 
+# добавление и удаление делят одно состояние StaffAdd.user_id — хендлер один, режим берём из remove_mode
+@router.message(StaffAdd.user_id, flags={"min_role": ROLE_ADMIN})
+async def staff_user_id_finish(m: Message, state: FSMContext):
     data = await state.get_data()
-    new_role = data.get("new_role")
-    try:
-        uid = int((m.text or "").strip())
-    except Exception:
+    uid = parse_user_id(m.text)
+    if data.get("remove_mode"):
+        return await staff_remove_finish(m, state, uid)
+    return await staff_add_finish(m, state, uid, data.get("new_role"))
+
+
+async def staff_add_finish(m: Message, state: FSMContext, uid: Optional[int], new_role: Optional[str]):
+    if uid is None:
         return await m.answer("Нужен user_id числом.")
 
     if OWNER_ID and uid == OWNER_ID:
@@ -1369,31 +1923,8 @@ async def staff_add_finish(m: Message, state: FSMContext):
     await m.answer(f"✅ Добавлено: {uid} → {new_role}. /admin")
 
 
-@router.callback_query(F.data == "staff:remove")
-async def staff_remove_start(c: CallbackQuery, state: FSMContext):
-    role = await get_staff_role(c.from_user.id)
-    if not role_at_least(role, ROLE_ADMIN):
-        return await c.answer("⛔ Нужно быть admin/owner", show_alert=True)
-    await safe_edit_text(c.message, "Отправьте user_id, которого удалить из staff:", reply_markup=kb_back("adm:staff"))
-    await state.set_state(StaffAdd.user_id)
-    await state.update_data(remove_mode=True)
-    await c.answer()
-
-
-@router.message(StaffAdd.user_id)
-async def staff_remove_finish(m: Message, state: FSMContext):
-    # этот хендлер уже используется выше; различим режим по remove_mode
-    data = await state.get_data()
-    if not data.get("remove_mode"):
-        return  # пусть отработает add_finish выше
-
-    role = await get_staff_role(m.from_user.id)
-    if not role_at_least(role, ROLE_ADMIN):
-        return
-
-    try:
-        uid = int((m.text or "").strip())
-    except Exception:
+async def staff_remove_finish(m: Message, state: FSMContext, uid: Optional[int]):
+    if uid is None:
         await state.clear()
         return await m.answer("Нужен user_id числом.")
 
@@ -1406,12 +1937,31 @@ async def staff_remove_finish(m: Message, state: FSMContext):
     await m.answer(f"✅ Удалено: {uid}. /admin")
 
 
+# -------------------- STALE CALLBACKS --------------------
+# Регистрируется последним: сюда попадают только колбэки, которые не подошли ни одному хендлеру, —
+# например кнопки старого формата (shop:cat:1) на сообщениях, отправленных до перехода на CallbackData.
+# Без ответа у пользователя так и крутился бы спиннер.
+@router.callback_query(flags=MANUAL_ANSWER)
+async def stale_callback(c: CallbackQuery):
+    await c.answer("Меню устарело, откройте /start")
+
+
 # -------------------- MAIN --------------------
 async def main():
     await init_db()
+    await warm_catalog()
+    dp.shutdown.register(close_db)
     me = await bot.get_me()
+    set_shop_url(me.username)
     log.info("Bot started as @%s", me.username)
-    await dp.start_polling(bot)
+    # только те типы апдейтов, на которые есть обработчики (message, callback_query)
+    await dp.start_polling(bot, allowed_updates=dp.resolve_used_update_types())
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    # uvloop — быстрее стандартного цикла; если не установлен (Windows, локальный запуск), работаем на asyncio
+    try:
+        import uvloop
+    except ImportError:
+        asyncio.run(main())
+    else:
+        uvloop.run(main())